@@ -8,7 +8,8 @@ app_license = "mit"
 # Apps
 # ------------------
 
-# required_apps = []
+# entropy.overrides subclasses ERPNext's Customer and Supplier controllers
+required_apps = ["erpnext"]
 
 # Each item in the list will be shown as an app in the apps page
 # add_to_apps_screen = [
@@ -83,7 +84,8 @@ app_license = "mit"
 # ------------
 
 # before_install = "entropy.install.before_install"
-# after_install = "entropy.install.after_install"
+after_install = "entropy.install.after_install"
+after_migrate = "entropy.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -133,30 +135,39 @@ app_license = "mit"
 # 	"ToDo": "custom_app.overrides.CustomToDo"
 # }
 
-# The important change - completely override the doctype classes
+# Only `autoname` is overridden; ERPNext's naming would otherwise run first and
+# increment its own naming series for every Customer/Supplier
 override_doctype_class = {
-    "Customer": "entropy.utils.custom_naming.CustomCustomer",
-    "Supplier": "entropy.utils.custom_naming.CustomSupplier"
+    "Customer": "entropy.overrides.CustomCustomer",
+    "Supplier": "entropy.overrides.CustomSupplier"
 }
 
 # Document Events
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-#     "Customer": {
-#         "autoname": "entropy.utils.custom_naming.CustomCustomer.autoname",
-#         "validate": "entropy.utils.custom_naming.CustomCustomer.validate"
-#     },
-#     "Supplier": {
-#         "autoname": "entropy.utils.custom_naming.CustomSupplier.autoname",
-#         "validate": "entropy.utils.custom_naming.CustomSupplier.validate"
-#     }
-# }
+doc_events = {
+    "Customer": {
+        "validate": "entropy.utils.custom_naming.customer_validate"
+    },
+    "Supplier": {
+        "validate": "entropy.utils.custom_naming.supplier_validate"
+    },
+    "Company": {
+        "on_update": "entropy.utils.custom_naming.clear_company_abbr_cache",
+        "on_trash": "entropy.utils.custom_naming.clear_company_abbr_cache"
+    }
+}
 
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "hourly": [
+        "entropy.utils.custom_naming.flush_series_counters"
+    ]
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"entropy.tasks.all"
@@ -0,0 +1,25 @@
+from entropy.patches import add_normalized_name_columns, add_unique_key_to_singles
+from entropy.utils.custom_naming import create_series_procedure
+
+
+def after_install():
+    """
+    Applies the schema changes the custom naming relies on.
+
+    Patches listed in `patches.txt` are only marked as completed on a fresh
+    install, so the ones the app cannot work without are run here explicitly.
+    """
+    add_unique_key_to_singles.execute()
+    add_normalized_name_columns.execute()
+    create_series_procedure()
+
+
+def after_migrate():
+    """
+    Recreates the series counter stored procedure.
+
+    Stored procedures are not part of `bench backup` dumps, so a restored site
+    loses it; running this on every migrate puts it back. Failing to create it
+    only logs a warning, so it never fails the migrate.
+    """
+    create_series_procedure()
@@ -0,0 +1,30 @@
+from erpnext.buying.doctype.supplier.supplier import Supplier
+from erpnext.selling.doctype.customer.customer import Customer
+
+from entropy.utils.custom_naming import customer_autoname, supplier_autoname
+
+
+class CustomCustomer(Customer):
+    """
+    ERPNext's Customer controller with the custom ID format.
+
+    Only `autoname` is overridden, so ERPNext's own naming (a `tabSeries` increment
+    under a row lock in "Naming Series" mode, a `LIKE` scan and a "Changed customer
+    name" message in "Customer Name" mode) never runs. All other controller logic,
+    and `customer_validate` via `doc_events`, stay as they are.
+    """
+
+    def autoname(self):
+        customer_autoname(self)
+
+
+class CustomSupplier(Supplier):
+    """
+    ERPNext's Supplier controller with the custom ID format.
+
+    Only `autoname` is overridden, so ERPNext's own naming never runs; see
+    `CustomCustomer`.
+    """
+
+    def autoname(self):
+        supplier_autoname(self)
@@ -0,0 +1,54 @@
+import frappe
+
+from entropy.utils.custom_naming import CUSTOMER_NAME_NORM_KEY, SUPPLIER_NAME_NORM_KEY
+
+# (doctype, name field, normalized column, key name)
+NORMALIZED_NAME_COLUMNS = (
+    ("Customer", "customer_name", "customer_name_norm", CUSTOMER_NAME_NORM_KEY),
+    ("Supplier", "supplier_name", "supplier_name_norm", SUPPLIER_NAME_NORM_KEY),
+)
+
+
+def execute():
+    """
+    Adds a stored `LOWER(TRIM(<name field>))` column with a key to Customer and Supplier.
+
+    The key is unique so the database itself rejects duplicate names, which the
+    duplicate check in `validate` cannot guarantee for concurrent inserts. Sites
+    that already contain duplicate names get a plain key instead, and the check in
+    `validate` keeps working there. Once the duplicates are cleaned up, running
+    this function again upgrades the key to a unique one.
+    """
+    for doctype, name_field, norm_column, key_name in NORMALIZED_NAME_COLUMNS:
+        table = f"tab{doctype}"
+
+        if not frappe.db.has_column(doctype, norm_column):
+            frappe.db.sql_ddl(f"""
+                ALTER TABLE `{table}`
+                ADD COLUMN `{norm_column}` VARCHAR(180)
+                AS (LOWER(TRIM(`{name_field}`))) STORED
+            """)
+
+        existing_key = frappe.db.sql(f"SHOW INDEX FROM `{table}` WHERE Key_name=%s", key_name, as_dict=True)
+        if existing_key and not existing_key[0].Non_unique:
+            continue
+
+        duplicate = frappe.db.sql(f"""
+            SELECT `{norm_column}`
+            FROM `{table}`
+            WHERE `{norm_column}` IS NOT NULL
+            GROUP BY `{norm_column}`
+            HAVING COUNT(*) > 1
+            LIMIT 1
+        """)
+        if duplicate:
+            print(f"{doctype} contains duplicate names (e.g. '{duplicate[0][0]}'). "
+                  f"Using a non-unique key `{key_name}`; resolve the duplicates and run "
+                  f"`bench execute {__name__}.execute` to enforce uniqueness in the database.")
+            if not existing_key:
+                frappe.db.sql_ddl(f"ALTER TABLE `{table}` ADD KEY `{key_name}` (`{norm_column}`)")
+            continue
+
+        if existing_key:
+            frappe.db.sql_ddl(f"ALTER TABLE `{table}` DROP KEY `{key_name}`")
+        frappe.db.sql_ddl(f"ALTER TABLE `{table}` ADD UNIQUE KEY `{key_name}` (`{norm_column}`)")
@@ -0,0 +1,90 @@
+import frappe
+
+from entropy.utils.custom_naming import SERIES_FIELDNAME_KEY
+
+# Name of the unique key over `tabSingles` (`doctype`, `field`)
+SINGLES_UNIQUE_KEY = "idx_doctype_field"
+
+
+def execute():
+    """
+    Adds a unique key over `tabSingles` (`doctype`, `field`).
+
+    The custom naming series counters are incremented with
+    `INSERT ... ON DUPLICATE KEY UPDATE`, which needs this key to detect an
+    existing counter row. Duplicate counter rows left behind by older versions
+    are collapsed to the highest value first, so no sequence number is reused.
+    Nothing is added if an equivalent unique key already exists under another name.
+
+    Raises:
+        frappe.ValidationError: If other (`doctype`, `field`) pairs are still duplicated.
+    """
+    duplicates = frappe.db.sql("""
+        SELECT `doctype`, MAX(CAST(`value` AS UNSIGNED))
+        FROM `tabSingles`
+        WHERE `field`=%s
+        GROUP BY `doctype`
+        HAVING COUNT(*) > 1
+    """, (SERIES_FIELDNAME_KEY,))
+
+    for series_key, max_value in duplicates:
+        frappe.db.sql("""
+            DELETE FROM `tabSingles`
+            WHERE `doctype`=%s AND `field`=%s
+        """, (series_key, SERIES_FIELDNAME_KEY))
+        frappe.db.sql("""
+            INSERT INTO `tabSingles` (`doctype`, `field`, `value`)
+            VALUES (%s, %s, %s)
+        """, (series_key, SERIES_FIELDNAME_KEY, str(max_value)))
+
+    if _has_unique_doctype_field_key():
+        return
+
+    _check_no_duplicate_pairs()
+    frappe.db.add_unique("Singles", ["doctype", "field"], constraint_name=SINGLES_UNIQUE_KEY)
+
+
+def _has_unique_doctype_field_key():
+    """Returns True if any unique key on `tabSingles` covers exactly (`doctype`, `field`)."""
+    unique_keys = {}
+    for index in frappe.db.sql("SHOW INDEX FROM `tabSingles`", as_dict=True):
+        if not index.Non_unique:
+            unique_keys.setdefault(index.Key_name, []).append((index.Seq_in_index, index.Column_name))
+
+    return any(
+        [column for _, column in sorted(columns)] == ["doctype", "field"]
+        for columns in unique_keys.values()
+    )
+
+
+def _check_no_duplicate_pairs():
+    """
+    Stops the patch if `tabSingles` still holds duplicate (`doctype`, `field`) pairs.
+
+    Only series counters are collapsed automatically; other duplicates (e.g. settings
+    saved twice by a custom script) must be resolved by hand, as picking a value for
+    them could change a setting. Grouping uses the column collation, so pairs that only
+    differ in case, which the unique key rejects under a `_ci` collation, are listed too.
+    """
+    duplicates = frappe.db.sql("""
+        SELECT `doctype`, `field`, COUNT(*)
+        FROM `tabSingles`
+        GROUP BY `doctype`, `field`
+        HAVING COUNT(*) > 1
+        ORDER BY `doctype`, `field`
+    """)
+    if not duplicates:
+        return
+
+    pairs = "<br>".join(
+        f"{frappe.bold(doctype)} / {frappe.bold(field)} ({count} rows)"
+        for doctype, field, count in duplicates
+    )
+    frappe.throw(
+        frappe._(
+            "Cannot add a unique key over tabSingles (doctype, field): the following pairs"
+            " have more than one row, possibly differing only in letter case. Keep one row"
+            " per pair, delete the others, then run bench migrate again:<br>{0}"
+        ).format(pairs),
+        title=frappe._("Duplicate Singles Values"),
+    )
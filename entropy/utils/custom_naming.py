@@ -1,6 +1,6 @@
 import frappe
-from frappe.model.document import Document
-import re
+import logging
+from functools import lru_cache, partial
 from frappe.utils import cstr, cint 
 from frappe.exceptions import DuplicateEntryError, ValidationError
 
@@ -14,9 +14,103 @@ SERIES_DOCTYPE_KEY = "CustomNameSeries" # Can be kept, but clarifies it's not a
 # The value we store in the `field` column of `tabSingles` to identify the counter value
 # This name itself doesn't matter much, as long as it's consistent.
 SERIES_FIELDNAME_KEY = "current_value"
+# Unique keys over the normalized (LOWER(TRIM(...))) name columns, used by the database
+# to reject duplicate names that slip past `validate` under concurrent inserts.
+CUSTOMER_NAME_NORM_KEY = "idx_cust_name_norm"
+SUPPLIER_NAME_NORM_KEY = "idx_supp_name_norm"
+# Site config flag moving series counters to Redis `INCR` (see `_increment_series_in_redis`)
+REDIS_SERIES_CONFIG_KEY = "entropy_redis_series_counters"
+# Redis key prefix for the series counters; the series key is appended
+REDIS_SERIES_KEY_PREFIX = "entropy:series:"
+
+# Advances a series counter by ARGV[1] only if it already exists in Redis; returns nil otherwise
+_REDIS_INCR_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+# Seeds a missing series counter with ARGV[1] and advances it by ARGV[2], atomically
+_REDIS_SEED_AND_INCR = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('INCRBY', KEYS[1], ARGV[2])
+"""
+# Maximum numbers reserved at once per series while a Data Import is running
+IMPORT_SERIES_BLOCK_SIZE = 50
+# Stored procedure advancing a series counter and returning the new value in one round-trip
+SERIES_PROCEDURE_NAME = "entropy_reserve_series"
+# MySQL/MariaDB error code for a stored procedure that does not exist (ER_SP_DOES_NOT_EXIST)
+_ER_SP_DOES_NOT_EXIST = 1305
+
+# str.translate table deleting every ASCII character that may not appear in a name prefix.
+# Non-ASCII characters are dropped beforehand, so only [a-zA-Z0-9] survives.
+_DELETE_TABLE = dict.fromkeys(i for i in range(128) if not chr(i).isalnum())
+
+# Logger instance, created on first use by `_log` (not at import time)
+_logger = None
+
+def _log():
+    """Returns the module logger, creating it on first use."""
+    global _logger
+    _logger = _logger or frappe.logger("custom_naming", allow_site=True)
+    return _logger
+
+# Sites on which `SERIES_PROCEDURE_NAME` is known to exist, in this process.
+# Only positive results are kept here; a missing procedure is remembered per request.
+_SERIES_PROCEDURE_SITES = set()
+
+def _company_abbr_cached(company):
+    """
+    Returns the abbreviation of `company`, memoized for the current request.
+
+    Misses are served by `frappe.get_cached_value`, i.e. the Redis document cache, which
+    Frappe invalidates on every Company save and `db.set_value` (as used by ERPNext's
+    `replace_abbr`), so a single save costs no SQL query. The memo itself lives on
+    `frappe.local` (like `_user_default_company`) and is discarded at the end of every
+    request or background job, so it can't go stale across processes; it saves the
+    Redis round-trip and unpickling for every further autoname in the same request
+    (e.g. a Data Import). Empty results are not memoized.
+    """
+    abbrs = getattr(frappe.local, "_entropy_company_abbr", None)
+    if abbrs is None:
+        abbrs = frappe.local._entropy_company_abbr = {}
+
+    abbr = abbrs.get(company)
+    if not abbr:
+        abbr = frappe.get_cached_value("Company", company, "abbr")
+        if abbr:
+            abbrs[company] = abbr
+    return abbr
+
+def clear_company_abbr_cache(doc, method=None):
+    """
+    Company `on_update` / `on_trash` hook: drops the company's abbreviation memoized in this request.
+
+    Other requests never see the memo; this only matters when a Company is changed and
+    Customers or Suppliers are named afterwards in the same request.
+    """
+    abbrs = getattr(frappe.local, "_entropy_company_abbr", None)
+    if abbrs:
+        abbrs.pop(doc.name, None)
+
+def _user_default_company():
+    """
+    Returns the current user's default company, memoized for the current request.
+
+    The value lives on `frappe.local`, which is discarded at the end of every request
+    or background job, so it can never go stale across requests. It is keyed by user
+    because jobs may switch users via `frappe.set_user`.
+    """
+    defaults = getattr(frappe.local, "_entropy_default_company", None)
+    if defaults is None:
+        defaults = frappe.local._entropy_default_company = {}
 
-# Get a logger instance
-logger = frappe.logger("custom_naming", allow_site=True)
+    user = frappe.session.user
+    if user not in defaults:
+        defaults[user] = frappe.defaults.get_user_default("company")
+    return defaults[user]
 
 def get_company_abbr(company=None):
     """
@@ -25,7 +119,7 @@ def get_company_abbr(company=None):
     If no company is provided, it attempts to fetch the default company
     for the current user. If no default is found, uses DEFAULT_COMPANY_ABBR.
 
-    Caches the result for performance.
+    Memoizes the result for the current request (see `_company_abbr_cached`).
 
     Args:
         company (str, optional): The name of the Company DocType. Defaults to None.
@@ -33,34 +127,41 @@ def get_company_abbr(company=None):
     Returns:
         str: The company abbreviation (e.g., "ABC") or the default ("CO").
     """
+    debug = _log().isEnabledFor(logging.DEBUG)
     if not company:
-        company = frappe.defaults.get_user_default("company")
-        logger.debug(f"No company provided or found on doc, using user default: {company}")
+        company = _user_default_company()
+        if debug:
+            _log().debug("No company provided or found on doc, using user default: %s", company)
 
     if not company:
-        logger.warning("No company found (user default or provided), using default abbreviation.")
+        _log().warning("No company found (user default or provided), using default abbreviation.")
         return DEFAULT_COMPANY_ABBR
 
     try:
-        # Use get_cached_value for efficiency
-        company_abbr = frappe.get_cached_value("Company", company, "abbr")
+        # Served from the request memo after the first lookup, so bulk naming skips the Redis round-trip
+        company_abbr = _company_abbr_cached(company)
         if not company_abbr:
-            logger.warning(f"Company '{company}' found, but abbreviation is empty. Using default.")
+            _log().warning("Company '%s' found, but abbreviation is empty. Using default.", company)
             return DEFAULT_COMPANY_ABBR
 
-        logger.debug(f"Fetched abbreviation '{company_abbr}' for company '{company}'.")
+        if debug:
+            _log().debug("Fetched abbreviation '%s' for company '%s'.", company_abbr, company)
         return company_abbr
     except Exception as e:
         # Log specific error if company lookup fails
-        logger.error(f"Error fetching abbreviation for company '{company}': {str(e)}", exc_info=True)
+        _log().error("Error fetching abbreviation for company '%s': %s", company, e, exc_info=True)
         return DEFAULT_COMPANY_ABBR
 
+@lru_cache(maxsize=1024)
 def get_name_prefix(name_field, max_length=MAX_PREFIX_LENGTH):
     """
     Extracts a clean, uppercase, alphanumeric prefix from a name string.
 
     Handles empty or non-alphanumeric names by returning DEFAULT_NAME_PREFIX.
 
+    The result depends only on the arguments, so it is memoized (bounded to 1024 entries)
+    for bulk imports and migrations that repeat the same names.
+
     Args:
         name_field (str): The input name (e.g., Customer Name, Supplier Name).
         max_length (int): The maximum length of the prefix.
@@ -68,33 +169,79 @@ def get_name_prefix(name_field, max_length=MAX_PREFIX_LENGTH):
     Returns:
         str: The generated prefix (e.g., "SPA") or the default ("UNK").
     """
+    debug = _log().isEnabledFor(logging.DEBUG)
     if not name_field:
-        logger.debug("Name field is empty, returning default prefix.")
+        if debug:
+            _log().debug("Name field is empty, returning default prefix.")
         return DEFAULT_NAME_PREFIX
 
-    logger.debug(f"Generating prefix for: '{name_field}'")
+    if debug:
+        _log().debug("Generating prefix for: '%s'", name_field)
 
-    # Remove non-alphanumeric characters
-    cleaned_name = re.sub(r'[^a-zA-Z0-9]', '', cstr(name_field))
+    # Remove non-alphanumeric characters: drop non-ASCII, then delete the rest via a lookup table
+    cleaned_name = cstr(name_field).encode("ascii", "ignore").decode("ascii").translate(_DELETE_TABLE)
 
     if not cleaned_name:
         # If cleaning resulted in an empty string (e.g., name was "---")
-        logger.debug("Name field contains no alphanumeric characters, returning default prefix.")
+        if debug:
+            _log().debug("Name field contains no alphanumeric characters, returning default prefix.")
         return DEFAULT_NAME_PREFIX
 
     # Take the first `max_length` characters and convert to uppercase
     prefix = cleaned_name[:max_length].upper()
 
-    logger.debug(f"Generated prefix: '{prefix}'")
+    if debug:
+        _log().debug("Generated prefix: '%s'", prefix)
     return prefix
 
 def _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING, initial_value=1):
     """
     Atomically retrieves and increments the next number for a given series key.
 
-    Uses the `tabSingles` table and database row locking (`FOR UPDATE`) to prevent
-    race conditions when multiple documents are saved concurrently. This is crucial
-    for ensuring unique IDs under load.
+    The counter itself is advanced by `_reserve_series_numbers`. During a Data Import
+    (`frappe.flags.in_import`), numbers are instead taken from a block reserved up front
+    by `_next_from_import_block`, so most imported rows need no counter query at all.
+
+    Args:
+        series_key (str): A unique key identifying the series (e.g., "CUSTSPAABC"). This
+                          will be stored in the `doctype` column of `tabSingles`.
+        padding (int): The number of digits for zero-padding (e.g., 3 -> 001).
+        initial_value (int): The starting number if the series doesn't exist yet.
+
+    Returns:
+        str: The next sequence number, zero-padded (e.g., "001", "042").
+
+    Raises:
+        Exception: Propagates database errors if the atomic update fails unexpectedly.
+    """
+    # --- Step 1: Take the next number, from the import block or the counter itself ---
+    if frappe.flags.in_import:
+        next_number = _next_from_import_block(series_key, initial_value)
+    else:
+        next_number = _reserve_series_numbers(series_key, 1, initial_value)
+
+    # --- Step 2: Format and return the result ---
+    # The transaction will commit automatically upon successful completion of the
+    # calling method (e.g., `autoname`), releasing the lock. If an error occurs
+    # before commit, the transaction rolls back, undoing the upsert.
+    formatted_number = f"{next_number:0{padding}d}"
+    if _log().isEnabledFor(logging.DEBUG):
+        _log().debug("Returning formatted number: '%s' for key '%s' / field '%s'", formatted_number, series_key, SERIES_FIELDNAME_KEY)
+    return formatted_number
+
+def _reserve_series_numbers(series_key, count=1, initial_value=1):
+    """
+    Advances a series counter by `count` and returns the last number reserved.
+
+    Uses the `tabSingles` table and a single `INSERT ... ON DUPLICATE KEY UPDATE` combined
+    with MySQL/MariaDB's `LAST_INSERT_ID(expr)` idiom, so initialization, increment and
+    read-back happen without an explicit `SELECT ... FOR UPDATE`. The upsert takes the row
+    lock (held until the surrounding transaction commits), and `LAST_INSERT_ID()` is
+    connection-local, so concurrent saves can never read each other's value. This is
+    crucial for ensuring unique IDs under load.
+
+    Relies on the unique key over `tabSingles` (`doctype`, `field`) added by the
+    `entropy.patches.add_unique_key_to_singles` patch.
 
     The `tabSingles` table is a key-value store in Frappe. We use:
     - `doctype` column: To store our unique series identifier (e.g., "CUSTSPAABC").
@@ -105,309 +252,450 @@ def _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING, initial_
     - `value` column: To store the actual last used number for the series.
 
     Args:
-        series_key (str): A unique key identifying the series (e.g., "CUSTSPAABC"). This
-                          will be stored in the `doctype` column of `tabSingles`.
-        padding (int): The number of digits for zero-padding (e.g., 3 -> 001).
+        series_key (str): A unique key identifying the series (e.g., "CUSTSPAABC").
+        count (int): How many consecutive numbers to reserve.
         initial_value (int): The starting number if the series doesn't exist yet.
 
     Returns:
-        str: The next sequence number, zero-padded (e.g., "001", "042").
+        int: The last reserved number; the block is `[result - count + 1, result]`.
+    """
+    # --- Optional: Increment the counter in Redis instead of the database ---
+    if frappe.conf.get(REDIS_SERIES_CONFIG_KEY):
+        return _increment_series_in_redis(series_key, count, initial_value)
 
-    Raises:
-        Exception: Propagates database errors if the atomic update fails unexpectedly.
-                   Also throws Frappe exception if initialization fails after concurrency detection.
-
-    Corrections Applied:
-        - Uses correct column name 'field' instead of 'fieldname'.
-        - Removed references to non-existent 'modified' column.
-    """
-    logger.debug(f"Getting next atomic series number for key: '{series_key}' using field: '{SERIES_FIELDNAME_KEY}'")
-
-    # --- Step 1: Try to select the existing value, locking the row ---
-    # The FOR UPDATE clause is essential for atomicity. It prevents other transactions
-    # from reading or writing this specific row until the current transaction completes.
-    # This query targets the specific row identified by our series_key (in doctype column)
-    # and our fixed field identifier (in field column).
-    current_val = frappe.db.sql(f"""
-        SELECT `value`
-        FROM `tabSingles`
-        WHERE `doctype`=%s AND `field`=%s
-        FOR UPDATE
-    """, (series_key, SERIES_FIELDNAME_KEY))
-
-    # --- Step 2: Handle if the series doesn't exist yet ---
-    if not current_val:
-        logger.debug(f"Series key '{series_key}' / field '{SERIES_FIELDNAME_KEY}' not found. Initializing.")
+    # --- Fast path: upsert and read-back fused into one stored procedure call ---
+    if _series_procedure_available():
         try:
-            # Insert the first record for this series.
-            # Note: No 'modified' column included here.
-            frappe.db.sql("""
-                INSERT INTO `tabSingles` (`doctype`, `field`, `value`)
-                VALUES (%s, %s, %s)
-            """, (series_key, SERIES_FIELDNAME_KEY, str(initial_value)))
-            next_number = initial_value
-            logger.debug(f"Initialized series '{series_key}' / field '{SERIES_FIELDNAME_KEY}' to {initial_value}.")
-
-        # --- Step 2a: Handle rare race condition during insertion ---
-        except DuplicateEntryError:
-            # This can happen if two processes check (`SELECT FOR UPDATE`), both find nothing,
-            # and then both try to `INSERT` almost simultaneously. One succeeds, the other gets this error.
-            # The `FOR UPDATE` lock makes this *very* unlikely, but we handle it defensively.
-            logger.warning(f"Concurrent creation detected for series '{series_key}' / field '{SERIES_FIELDNAME_KEY}'. Re-fetching with lock.")
-            # Re-query *with the lock* to get the value inserted by the other process.
-            current_val = frappe.db.sql(f"""
-                SELECT `value`
-                FROM `tabSingles`
-                WHERE `doctype`=%s AND `field`=%s
-                FOR UPDATE
-            """, (series_key, SERIES_FIELDNAME_KEY))
-
-            # If it's *still* not found after a DuplicateEntryError, something is deeply wrong.
-            if not current_val:
-                 logger.error(f"CRITICAL: Failed to retrieve series counter for '{series_key}' / '{SERIES_FIELDNAME_KEY}' even after DuplicateEntryError.")
-                 frappe.throw(f"Failed to initialize or retrieve series counter for '{series_key}' / '{SERIES_FIELDNAME_KEY}' after concurrency issue.")
-
-            # If re-fetch succeeded, proceed to increment the value found.
-            last_number = cint(current_val[0][0])
-            next_number = last_number + 1
-            logger.debug(f"After concurrent creation, fetched last_number: {last_number}, calculating next: {next_number}")
-            # Update the value (incrementing what the other process inserted).
-            # Note: No 'modified' column included here.
-            frappe.db.sql("""
-                UPDATE `tabSingles`
-                SET `value`=%s
-                WHERE `doctype`=%s AND `field`=%s
-            """, (str(next_number), series_key, SERIES_FIELDNAME_KEY))
-            logger.debug(f"Updated series '{series_key}' / field '{SERIES_FIELDNAME_KEY}' to {next_number} after handling concurrency.")
-
-    # --- Step 3: Handle if the series already exists ---
+            last_number = cint(frappe.db.sql(
+                f"CALL `{SERIES_PROCEDURE_NAME}`(%s, %s, %s, %s)",
+                (series_key, SERIES_FIELDNAME_KEY, count, cint(initial_value))
+            )[0][0])
+        except Exception as e:
+            # The procedure can vanish from under a running worker, e.g. after restoring a
+            # backup (dumps don't include routines). Fall back until the next migrate.
+            if not e.args or e.args[0] != _ER_SP_DOES_NOT_EXIST:
+                raise
+            _SERIES_PROCEDURE_SITES.discard(frappe.local.site)
+            frappe.local._entropy_series_procedure_missing = True
+        else:
+            if _log().isEnabledFor(logging.DEBUG):
+                _log().debug("Updated series '%s' / field '%s' to %s.", series_key, SERIES_FIELDNAME_KEY, last_number)
+            return last_number
+
+    # --- Initialize or increment the counter in a single statement ---
+    # The unique key on `tabSingles` (`doctype`, `field`) turns this into an atomic upsert:
+    # a missing series is created starting at `initial_value`, an existing one is advanced.
+    # `LAST_INSERT_ID(expr)` remembers the resulting value for this connection, so it can
+    # be read back without touching the (now locked) row again.
+    frappe.db.sql("""
+        INSERT INTO `tabSingles` (`doctype`, `field`, `value`)
+        VALUES (%s, %s, LAST_INSERT_ID(%s))
+        ON DUPLICATE KEY UPDATE `value` = LAST_INSERT_ID(CAST(`value` AS UNSIGNED) + %s)
+    """, (series_key, SERIES_FIELDNAME_KEY, cint(initial_value) + count - 1, count))
+
+    # --- Read back the value produced by this connection ---
+    last_number = cint(frappe.db.sql("SELECT LAST_INSERT_ID()")[0][0])
+    if _log().isEnabledFor(logging.DEBUG):
+        _log().debug("Updated series '%s' / field '%s' to %s.", series_key, SERIES_FIELDNAME_KEY, last_number)
+    return last_number
+
+def _series_procedure_available():
+    """
+    Returns True if the `SERIES_PROCEDURE_NAME` stored procedure exists on this site.
+
+    A positive answer is kept for the life of the process, a negative one only for the
+    current request, so sites picking up the procedure on migrate switch over without
+    a restart.
+    """
+    site = frappe.local.site
+    if site in _SERIES_PROCEDURE_SITES:
+        return True
+    if getattr(frappe.local, "_entropy_series_procedure_missing", False):
+        return False
+
+    exists = frappe.db.sql("""
+        SELECT 1
+        FROM information_schema.ROUTINES
+        WHERE ROUTINE_SCHEMA = DATABASE()
+        AND ROUTINE_TYPE = 'PROCEDURE'
+        AND ROUTINE_NAME = %s
+    """, (SERIES_PROCEDURE_NAME,))
+    if exists:
+        _SERIES_PROCEDURE_SITES.add(site)
     else:
-        # The `SELECT FOR UPDATE` was successful and returned the current value.
-        last_number = cint(current_val[0][0])
-        next_number = last_number + 1
-        logger.debug(f"Series key '{series_key}' / field '{SERIES_FIELDNAME_KEY}' found. Last value: {last_number}, Next value: {next_number}")
-        # Update the row (which is still locked by `FOR UPDATE`) with the incremented value.
-        # Note: No 'modified' column included here.
-        frappe.db.sql("""
-            UPDATE `tabSingles`
-            SET `value`=%s
+        frappe.local._entropy_series_procedure_missing = True
+    return bool(exists)
+
+def create_series_procedure():
+    """
+    (Re)creates the `SERIES_PROCEDURE_NAME` stored procedure used by `_reserve_series_numbers`.
+
+    The procedure runs the same `INSERT ... ON DUPLICATE KEY UPDATE` / `LAST_INSERT_ID()`
+    pair as the fallback path, but inside the database, so reserving a series number
+    costs one round-trip instead of two. Called on install and after every migrate,
+    since database dumps taken by `bench backup` don't carry stored procedures.
+
+    The default-company and abbreviation lookups are deliberately left out. The first
+    autoname of a request still pays them, but as Redis reads (`frappe.defaults` and the
+    document cache), not database round-trips. Resolving the user's default company in
+    SQL would also mean re-implementing `frappe.defaults` (user, then global defaults),
+    and the name prefix would have to duplicate `get_name_prefix`.
+
+    Runs through `frappe.db.sql_ddl`, which commits pending writes (e.g. those of
+    `bench migrate`) first, as DDL would commit them implicitly anyway.
+
+    Best-effort: the procedure is only an optimization, so on databases other than
+    MariaDB/MySQL, or if creating it fails (e.g. the database user lacks the
+    CREATE ROUTINE privilege), a warning is logged and install/migrate carry on;
+    `_reserve_series_numbers` then keeps using the two-statement path.
+    """
+    if frappe.db.db_type != "mariadb":
+        _log().info("Skipping series procedure: not supported on %s.", frappe.db.db_type)
+        return
+
+    try:
+        _create_series_procedure()
+    except Exception:
+        _SERIES_PROCEDURE_SITES.discard(frappe.local.site)
+        _log().warning("Could not create the '%s' stored procedure; series numbers will be "
+                       "reserved without it.", SERIES_PROCEDURE_NAME, exc_info=True)
+
+def _create_series_procedure():
+    """Drops and creates the `SERIES_PROCEDURE_NAME` stored procedure; see `create_series_procedure`."""
+    frappe.db.sql_ddl(f"DROP PROCEDURE IF EXISTS `{SERIES_PROCEDURE_NAME}`")
+    frappe.db.sql_ddl(f"""
+        CREATE PROCEDURE `{SERIES_PROCEDURE_NAME}`(
+            IN p_series_key VARCHAR(255),
+            IN p_field VARCHAR(255),
+            IN p_count INT,
+            IN p_initial_value BIGINT
+        )
+        BEGIN
+            INSERT INTO `tabSingles` (`doctype`, `field`, `value`)
+            VALUES (p_series_key, p_field, LAST_INSERT_ID(p_initial_value + p_count - 1))
+            ON DUPLICATE KEY UPDATE `value` = LAST_INSERT_ID(CAST(`value` AS UNSIGNED) + p_count);
+            SELECT LAST_INSERT_ID();
+        END
+    """)
+    _SERIES_PROCEDURE_SITES.add(frappe.local.site)
+
+def _next_from_import_block(series_key, initial_value=1):
+    """
+    Returns the next number for `series_key` from a block reserved for the current import.
+
+    Data Import inserts rows one by one, so without this every row would run its own
+    counter upsert. Instead, numbers are reserved in blocks in one statement and later
+    rows consume them from `frappe.local`. Block sizes grow geometrically per series
+    (1, 2, 4, ... up to `IMPORT_SERIES_BLOCK_SIZE`), so a series only used by a few rows
+    reserves few numbers, while long runs still need one upsert per 50 rows. Numbers
+    left over at the end of the import become gaps, which the series already allows.
+
+    If the transaction that reserved a block is rolled back (Data Import rolls back
+    failed rows), the reservation is undone in the database, so the block is discarded
+    as well. Blocks reserved in Redis are never rolled back and are kept.
+    """
+    blocks = getattr(frappe.local, "_entropy_series_blocks", None)
+    if blocks is None:
+        blocks = frappe.local._entropy_series_blocks = {}
+
+    # Blocks are [next_number, last_number, size]
+    block = blocks.get(series_key)
+    if not block or block[0] > block[1]:
+        size = min(block[2] * 2, IMPORT_SERIES_BLOCK_SIZE) if block else 1
+        last_number = _reserve_series_numbers(series_key, size, initial_value)
+        block = blocks[series_key] = [last_number - size + 1, last_number, size]
+        _log().debug("Reserved series block %s-%s for key '%s'.", block[0], block[1], series_key)
+        if not frappe.conf.get(REDIS_SERIES_CONFIG_KEY):
+            frappe.db.after_rollback.add(partial(_discard_import_block, blocks, series_key, block))
+
+    next_number = block[0]
+    block[0] += 1
+    return next_number
+
+def _discard_import_block(blocks, series_key, block):
+    """Rollback callback: forgets an import block whose reservation was undone."""
+    if blocks.get(series_key) is block:
+        del blocks[series_key]
+
+def _increment_series_in_redis(series_key, count=1, initial_value=1):
+    """
+    Increments a series counter with Redis `INCRBY` instead of a `tabSingles` row lock.
+
+    Enabled per site with the `entropy_redis_series_counters` site config flag. `INCRBY` is
+    atomic and lock-free, so bulk imports no longer serialize on the counter row. A counter
+    missing from Redis is seeded from its persisted `tabSingles` value; the hourly
+    `flush_series_counters` job writes the Redis values back.
+
+    Trade-offs: increments are not rolled back with the transaction (gaps, which a
+    rollback could already cause), and if Redis loses a key, numbers issued since the
+    last flush can be handed out again. Only enable this where the Redis cache does not
+    evict keys.
+
+    Args:
+        series_key (str): A unique key identifying the series (e.g., "CUSTSPAABC").
+        count (int): How many consecutive numbers to reserve.
+        initial_value (int): The starting number if the series doesn't exist yet.
+
+    Returns:
+        int: The last reserved number.
+    """
+    cache = frappe.cache()
+    redis_key = cache.make_key(REDIS_SERIES_KEY_PREFIX + series_key)
+
+    last_number = cache.eval(_REDIS_INCR_IF_EXISTS, 1, redis_key, count)
+    if last_number is None:
+        stored = frappe.db.sql("""
+            SELECT `value`
+            FROM `tabSingles`
             WHERE `doctype`=%s AND `field`=%s
-        """, (str(next_number), series_key, SERIES_FIELDNAME_KEY))
-        logger.debug(f"Updated series '{series_key}' / field '{SERIES_FIELDNAME_KEY}' to {next_number}.")
+        """, (series_key, SERIES_FIELDNAME_KEY))
+        seed = cint(stored[0][0]) if stored else cint(initial_value) - 1
+        _log().debug("Seeding Redis counter for series '%s' with %s.", series_key, seed)
+        last_number = cache.eval(_REDIS_SEED_AND_INCR, 1, redis_key, seed, count)
 
+    return cint(last_number)
 
-    # --- Step 4: Format and return the result ---
-    # The transaction will commit automatically upon successful completion of the
-    # calling method (e.g., `autoname`), releasing the lock. If an error occurs
-    # before commit, the transaction rolls back, undoing the INSERT/UPDATE.
-    formatted_number = cstr(next_number).zfill(padding)
-    logger.debug(f"Returning formatted number: '{formatted_number}' for key '{series_key}' / field '{SERIES_FIELDNAME_KEY}'")
-    return formatted_number
+def flush_series_counters():
+    """
+    Scheduler job (hourly): persists the Redis series counters to `tabSingles`.
+
+    Never moves a persisted counter backwards, so it is safe to run while the counters
+    are in use or after the feature has been switched off. It flushes whatever series
+    keys exist in Redis regardless of `REDIS_SERIES_CONFIG_KEY`; the flag should still
+    only be switched off right after a flush (see docs/custom_naming.md), because
+    numbers issued in between would otherwise be handed out again by the database path.
+    """
+    cache = frappe.cache()
+    prefix = cache.make_key(REDIS_SERIES_KEY_PREFIX)
+    for redis_key in cache.scan_iter(match=prefix + b"*"):
+        value = cache.get(redis_key)
+        if value is None:
+            continue
+        series_key = redis_key[len(prefix):].decode()
+        frappe.db.sql("""
+            INSERT INTO `tabSingles` (`doctype`, `field`, `value`)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE `value` = GREATEST(CAST(`value` AS UNSIGNED), CAST(VALUES(`value`) AS UNSIGNED))
+        """, (series_key, SERIES_FIELDNAME_KEY, cint(value)))
+    _log().debug("Flushed Redis series counters to tabSingles.")
+
+# --- Document Handlers (autoname via entropy.overrides, validate via hooks.py `doc_events`) ---
+
+def customer_autoname(doc, method=None):
+    """
+    Sets the document `name` (ID) automatically using the format:
+    [CUSTOMER_NAME_PREFIX][COMPANY_ABBR][ATOMIC_SEQ_NUM]
+    Example: CUSABC001
+
+    Relies on the user's default company if no company context is directly
+    available on the Customer document during autonaming (as Customer DocType
+    doesn't have a direct 'company' link field).
 
-class CustomCustomer(Document):
+    Raises:
+        frappe.ValidationError: If Customer Name is missing.
     """
-    Custom Customer DocType class with enhanced naming and duplicate prevention.
+    if not doc.customer_name:
+        # Ensure the primary input for the name is present
+        raise ValidationError(frappe._("Customer Name is required to generate the ID."))
+
+    # Safely get the company value from the document, if available.
+    # This will often be None for Customer, as it doesn't have a direct 'company' field.
+    company_from_doc = doc.get("company")
+    if _log().isEnabledFor(logging.DEBUG):
+        _log().debug("Autonaming Customer: '%s', Company from Doc (if any): '%s'", doc.customer_name, company_from_doc)
+
+    # 1. Get Company Abbreviation
+    # get_company_abbr gracefully handles None by checking user defaults.
+    company_abbr = get_company_abbr(company_from_doc)
+
+    # 2. Get Name Prefix
+    # Extracts prefix like 'SPA' from 'Spar'.
+    name_prefix = get_name_prefix(doc.customer_name)
+
+    # 3. Construct the unique series key for the atomic counter
+    # This key combines identifying information to ensure separate sequences
+    # for different name prefixes and companies.
+    # Example: 'CUST' + 'SPA' + 'ABC' -> "CUSTSPAABC"
+    series_key = f"CUST{name_prefix}{company_abbr}"
+
+    # 4. Get the next sequence number atomically using the helper function
+    try:
+        # This function handles the complexities of atomic incrementing via tabSingles
+        sequence_number = _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING)
+    except Exception as e:
+         # Catch potential errors from the atomic counter function
+         _log().error("Failed to get next series number for key '%s': %s", series_key, e, exc_info=True)
+         # Provide clear feedback to the user
+         frappe.throw(
+             frappe._("Failed to generate the next ID number. Please check the logs or try again. Error: {0}").format(str(e)),
+             title="ID Generation Failed"
+         )
+         return # Exit autoname if ID generation fails
+
+    # 5. Combine parts to form the final document name (ID)
+    doc.name = f"{name_prefix}{company_abbr}{sequence_number}"
+    _log().info("Generated Customer ID: %s for Customer Name: '%s', using Company Abbr: '%s'", doc.name, doc.customer_name, company_abbr)
+
+def customer_validate(doc, method=None):
+    """
+    Validates the Customer document before saving.
 
-    Overrides `autoname` to generate IDs based on Customer Name prefix,
-    Company Abbreviation, and an atomic counter.
-    Overrides `validate` to prevent duplicate Customer Names (case-insensitive).
+    Ensures Customer Name is provided.
+    Prevents saving if another Customer exists with the same Customer Name
+    (case-insensitive comparison, ignoring leading/trailing whitespace).
+    The duplicate check only runs for new documents or when the name changed.
+    """
+    debug = _log().isEnabledFor(logging.DEBUG)
+    if not doc.customer_name:
+        # Validation consistency: Customer Name is mandatory.
+        raise ValidationError(frappe._("Customer Name cannot be empty."))
+
+    # Nothing to check if an existing customer is saved without renaming it.
+    if not doc.is_new() and not doc.has_value_changed("customer_name"):
+        if debug:
+            _log().debug("Customer Name unchanged for %s, skipping duplicate check.", doc.name)
+        return
+
+    # Prepare the name for case-insensitive and whitespace-insensitive comparison
+    normalized_customer_name = cstr(doc.customer_name).strip().lower()
+
+    # Query for existing customers with the same normalized name.
+    # `customer_name_norm` is a stored LOWER(TRIM(customer_name)) column with its own key
+    # (see entropy.patches.add_normalized_name_columns), so this is an index lookup
+    # rather than a full table scan.
+    # A new document has no row yet, so there is nothing to exclude. For an existing one,
+    # `name != %s` is crucial to allow saving updates to an existing customer without
+    # triggering the duplicate check against itself.
+    if doc.is_new():
+        existing = frappe.db.sql("""
+            SELECT name
+            FROM `tabCustomer`
+            WHERE customer_name_norm = %s
+            LIMIT 1
+        """, (normalized_customer_name,))
+    else:
+        existing = frappe.db.sql("""
+            SELECT name
+            FROM `tabCustomer`
+            WHERE customer_name_norm = %s
+            AND name != %s
+            LIMIT 1
+        """, (normalized_customer_name, doc.name))
+
+    # If the query returned a result, a duplicate exists.
+    # Only the name is selected, as a plain tuple; the existing record's display name is
+    # fetched for the error message alone, keeping the common (no duplicate) path lean.
+    if existing:
+        existing_name = existing[0][0]
+        _log().warning("Validation failed: Duplicate customer name '%s' found. Existing record: %s", doc.customer_name, existing_name)
+        # Throw a specific DuplicateEntryError for better error handling/reporting.
+        # Provide clear, translatable feedback to the user.
+        frappe.throw(
+            frappe._("A Customer with the name '{0}' already exists: {1}").format(
+                frappe.db.get_value("Customer", existing_name, "customer_name"), frappe.bold(existing_name)
+            ),
+            exc=DuplicateEntryError, # Specify the exception type
+            title="Duplicate Name"
+        )
+    if debug:
+        _log().debug("Customer validation passed for: %s", doc.name or '(New Document)')
+
+def supplier_autoname(doc, method=None):
     """
+    Sets the document `name` (ID) automatically using the format:
+    [SUPPLIER_NAME_PREFIX][COMPANY_ABBR][ATOMIC_SEQ_NUM]
+    Example: SUPSPAABC001
 
-    def autoname(self):
-        """
-        Sets the document `name` (ID) automatically using the format:
-        [CUSTOMER_NAME_PREFIX][COMPANY_ABBR][ATOMIC_SEQ_NUM]
-        Example: CUSABC001
+    Relies on the user's default company if no company context is directly
+    available on the Supplier document during autonaming. Uses `doc.get`
+    for safe access, although Supplier often *does* have a company field.
 
-        Relies on the user's default company if no company context is directly
-        available on the Customer document during autonaming (as Customer DocType
-        doesn't have a direct 'company' link field).
+    Raises:
+        frappe.ValidationError: If Supplier Name is missing.
+    """
+    if not doc.supplier_name:
+        raise ValidationError(frappe._("Supplier Name is required to generate the ID."))
 
-        Raises:
-            frappe.ValidationError: If Customer Name is missing.
-        """
-        if not self.customer_name:
-            # Ensure the primary input for the name is present
-            raise ValidationError(frappe._("Customer Name is required to generate the ID."))
+    # Safely get the company value, using .get() for robustness.
+    company_from_doc = doc.get("company")
+    if _log().isEnabledFor(logging.DEBUG):
+        _log().debug("Autonaming Supplier: '%s', Company from Doc (if any): '%s'", doc.supplier_name, company_from_doc)
 
-        # Safely get the company value from the document, if available.
-        # This will often be None for Customer, as it doesn't have a direct 'company' field.
-        company_from_doc = self.get("company")
-        logger.debug(f"Autonaming Customer: '{self.customer_name}', Company from Doc (if any): '{company_from_doc}'")
+    # 1. Get Company Abbreviation
+    company_abbr = get_company_abbr(company_from_doc)
 
-        # 1. Get Company Abbreviation
-        # get_company_abbr gracefully handles None by checking user defaults.
-        company_abbr = get_company_abbr(company_from_doc)
+    # 2. Get Name Prefix
+    name_prefix = get_name_prefix(doc.supplier_name)
 
-        # 2. Get Name Prefix
-        # Extracts prefix like 'SPA' from 'Spar'.
-        name_prefix = get_name_prefix(self.customer_name)
+    # 3. Construct the unique series key for the atomic counter
+    # Example: 'SUPP' + 'SPA' + 'ABC' -> "SUPPSPAABC"
+    series_key = f"SUPP{name_prefix}{company_abbr}"
 
-        # 3. Construct the unique series key for the atomic counter
-        # This key combines identifying information to ensure separate sequences
-        # for different name prefixes and companies.
-        # Example: 'CUST' + 'SPA' + 'ABC' -> "CUSTSPAABC"
-        series_key = f"CUST{name_prefix}{company_abbr}"
+    # 4. Get the next sequence number atomically
+    try:
+        sequence_number = _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING)
+    except Exception as e:
+         _log().error("Failed to get next series number for key '%s': %s", series_key, e, exc_info=True)
+         frappe.throw(
+             frappe._("Failed to generate the next ID number. Please check the logs or try again. Error: {0}").format(str(e)),
+             title="ID Generation Failed"
+         )
+         return # Exit autoname
+
+    # 5. Combine parts to form the final document name (ID)
+    doc.name = f"{name_prefix}{company_abbr}{sequence_number}"
+    _log().info("Generated Supplier ID: %s for Supplier Name: '%s', using Company Abbr: '%s'", doc.name, doc.supplier_name, company_abbr)
+
+def supplier_validate(doc, method=None):
+    """
+    Validates the Supplier document before saving.
 
-        # 4. Get the next sequence number atomically using the helper function
-        try:
-            # This function handles the complexities of atomic incrementing via tabSingles
-            sequence_number = _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING)
-        except Exception as e:
-             # Catch potential errors from the atomic counter function
-             logger.error(f"Failed to get next series number for key '{series_key}': {str(e)}", exc_info=True)
-             # Provide clear feedback to the user
-             frappe.throw(
-                 frappe._("Failed to generate the next ID number. Please check the logs or try again. Error: {0}").format(str(e)),
-                 title="ID Generation Failed"
-             )
-             return # Exit autoname if ID generation fails
-
-        # 5. Combine parts to form the final document name (ID)
-        self.name = f"{name_prefix}{company_abbr}{sequence_number}"
-        logger.info(f"Generated Customer ID: {self.name} for Customer Name: '{self.customer_name}', using Company Abbr: '{company_abbr}'")
-
-    def validate(self):
-        """
-        Validates the Customer document before saving.
-
-        Ensures Customer Name is provided.
-        Prevents saving if another Customer exists with the same Customer Name
-        (case-insensitive comparison, ignoring leading/trailing whitespace).
-        """
-        if not self.customer_name:
-            # Validation consistency: Customer Name is mandatory.
-            raise ValidationError(frappe._("Customer Name cannot be empty."))
-
-        # Prepare the name for case-insensitive and whitespace-insensitive comparison
-        normalized_customer_name = cstr(self.customer_name).strip().lower()
-
-        # Placeholder for the current document's name. If it's a new document ('__islocal'),
-        # self.name might not be set yet. Using a highly unlikely placeholder avoids
-        # matching against NULL or an empty string in the DB query.
-        current_name = self.name if not self.is_new() else "@@@NEW_DOC_PLACEHOLDER@@@"
-
-        # Query for existing customers with the same normalized name, *excluding* the current document.
-        # The `name != %(current_name)s` is crucial to allow saving updates to an existing customer
-        # without triggering the duplicate check against itself.
+    Ensures Supplier Name is provided.
+    Prevents saving if another Supplier exists with the same Supplier Name
+    (case-insensitive comparison, ignoring leading/trailing whitespace).
+    The duplicate check only runs for new documents or when the name changed.
+    """
+    debug = _log().isEnabledFor(logging.DEBUG)
+    if not doc.supplier_name:
+        raise ValidationError(frappe._("Supplier Name cannot be empty."))
+
+    # Skip the duplicate check if the name did not change on an existing supplier
+    if not doc.is_new() and not doc.has_value_changed("supplier_name"):
+        if debug:
+            _log().debug("Supplier Name unchanged for %s, skipping duplicate check.", doc.name)
+        return
+
+    # Normalize the name for comparison
+    normalized_supplier_name = cstr(doc.supplier_name).strip().lower()
+
+    # Query for existing suppliers with the same normalized name, excluding this document
+    # when it is already saved. Uses the indexed `supplier_name_norm` column (LOWER(TRIM(supplier_name))).
+    if doc.is_new():
         existing = frappe.db.sql("""
-            SELECT name, customer_name
-            FROM `tabCustomer`
-            WHERE LOWER(TRIM(customer_name)) = %(normalized_name)s
-            AND name != %(current_name)s
+            SELECT name
+            FROM `tabSupplier`
+            WHERE supplier_name_norm = %s
             LIMIT 1
-        """, {
-            "normalized_name": normalized_customer_name,
-            "current_name": current_name
-        }, as_dict=True)
-
-        # If the query returned a result, a duplicate exists.
-        if existing:
-            existing_doc = existing[0]
-            logger.warning(f"Validation failed: Duplicate customer name '{self.customer_name}' found. Existing record: {existing_doc.name}")
-            # Throw a specific DuplicateEntryError for better error handling/reporting.
-            # Provide clear, translatable feedback to the user.
-            frappe.throw(
-                frappe._("A Customer with the name '{0}' already exists: {1}").format(
-                    existing_doc.customer_name, frappe.bold(existing_doc.name)
-                ),
-                exc=DuplicateEntryError, # Specify the exception type
-                title="Duplicate Name"
-            )
-        logger.debug(f"Customer validation passed for: {self.name or '(New Document)'}")
-
-
-class CustomSupplier(Document):
-    """
-    Custom Supplier DocType class with enhanced naming and duplicate prevention.
-
-    Overrides `autoname` to generate IDs based on Supplier Name prefix,
-    Company Abbreviation, and an atomic counter.
-    Overrides `validate` to prevent duplicate Supplier Names (case-insensitive).
-    """
-
-    def autoname(self):
-        """
-        Sets the document `name` (ID) automatically using the format:
-        [SUPPLIER_NAME_PREFIX][COMPANY_ABBR][ATOMIC_SEQ_NUM]
-        Example: SUPSPAABC001
-
-        Relies on the user's default company if no company context is directly
-        available on the Supplier document during autonaming. Uses `self.get`
-        for safe access, although Supplier often *does* have a company field.
-
-        Raises:
-            frappe.ValidationError: If Supplier Name is missing.
-        """
-        if not self.supplier_name:
-            raise ValidationError(frappe._("Supplier Name is required to generate the ID."))
-
-        # Safely get the company value, using .get() for robustness.
-        company_from_doc = self.get("company")
-        logger.debug(f"Autonaming Supplier: '{self.supplier_name}', Company from Doc (if any): '{company_from_doc}'")
-
-        # 1. Get Company Abbreviation
-        company_abbr = get_company_abbr(company_from_doc)
-
-        # 2. Get Name Prefix
-        name_prefix = get_name_prefix(self.supplier_name)
-
-        # 3. Construct the unique series key for the atomic counter
-        # Example: 'SUPP' + 'SPA' + 'ABC' -> "SUPPSPAABC"
-        series_key = f"SUPP{name_prefix}{company_abbr}"
-
-        # 4. Get the next sequence number atomically
-        try:
-            sequence_number = _get_next_series_number_atomic(series_key, padding=DEFAULT_PADDING)
-        except Exception as e:
-             logger.error(f"Failed to get next series number for key '{series_key}': {str(e)}", exc_info=True)
-             frappe.throw(
-                 frappe._("Failed to generate the next ID number. Please check the logs or try again. Error: {0}").format(str(e)),
-                 title="ID Generation Failed"
-             )
-             return # Exit autoname
-
-        # 5. Combine parts to form the final document name (ID)
-        self.name = f"{name_prefix}{company_abbr}{sequence_number}"
-        logger.info(f"Generated Supplier ID: {self.name} for Supplier Name: '{self.supplier_name}', using Company Abbr: '{company_abbr}'")
-
-    def validate(self):
-        """
-        Validates the Supplier document before saving.
-
-        Ensures Supplier Name is provided.
-        Prevents saving if another Supplier exists with the same Supplier Name
-        (case-insensitive comparison, ignoring leading/trailing whitespace).
-        """
-        if not self.supplier_name:
-            raise ValidationError(frappe._("Supplier Name cannot be empty."))
-
-        # Normalize the name for comparison
-        normalized_supplier_name = cstr(self.supplier_name).strip().lower()
-        # Use placeholder for name if document is new
-        current_name = self.name if not self.is_new() else "@@@NEW_DOC_PLACEHOLDER@@@"
-
-        # Query for existing suppliers with the same normalized name, excluding self.
+        """, (normalized_supplier_name,))
+    else:
         existing = frappe.db.sql("""
-            SELECT name, supplier_name
+            SELECT name
             FROM `tabSupplier`
-            WHERE LOWER(TRIM(supplier_name)) = %(normalized_name)s
-            AND name != %(current_name)s
+            WHERE supplier_name_norm = %s
+            AND name != %s
             LIMIT 1
-        """, {
-            "normalized_name": normalized_supplier_name,
-            "current_name": current_name
-        }, as_dict=True)
-
-        # Handle duplicate finding
-        if existing:
-            existing_doc = existing[0]
-            logger.warning(f"Validation failed: Duplicate supplier name '{self.supplier_name}' found. Existing record: {existing_doc.name}")
-            frappe.throw(
-                frappe._("A Supplier with the name '{0}' already exists: {1}").format(
-                    existing_doc.supplier_name, frappe.bold(existing_doc.name)
-                ),
-                exc=DuplicateEntryError, # Specify exception type
-                title="Duplicate Name"
-            )
-        logger.debug(f"Supplier validation passed for: {self.name or '(New Document)'}")
+        """, (normalized_supplier_name, doc.name))
+
+    # Handle duplicate finding
+    if existing:
+        existing_name = existing[0][0]
+        _log().warning("Validation failed: Duplicate supplier name '%s' found. Existing record: %s", doc.supplier_name, existing_name)
+        frappe.throw(
+            frappe._("A Supplier with the name '{0}' already exists: {1}").format(
+                frappe.db.get_value("Supplier", existing_name, "supplier_name"), frappe.bold(existing_name)
+            ),
+            exc=DuplicateEntryError, # Specify exception type
+            title="Duplicate Name"
+        )
+    if debug:
+        _log().debug("Supplier validation passed for: %s", doc.name or '(New Document)')
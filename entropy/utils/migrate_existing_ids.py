@@ -2,14 +2,18 @@ import frappe
 import re
 import argparse
 import sys
-from frappe.utils import cstr, cint
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from logging.handlers import MemoryHandler
 from frappe.exceptions import DoesNotExistError
 
 # Import the *correct* naming helpers from your finalized custom_naming script
 # Make sure the path is correct for your app structure
 try:
     # Adjust the import path based on your app name ('entropy') and file location
-    from entropy.utils.custom_naming import get_name_prefix, get_company_abbr, DEFAULT_PADDING, MAX_PREFIX_LENGTH 
+    from entropy.utils.custom_naming import get_name_prefix, get_company_abbr, DEFAULT_NAME_PREFIX, DEFAULT_PADDING, MAX_PREFIX_LENGTH
 except ImportError:
     print("ERROR: Could not import naming helpers from entropy.utils.custom_naming.")
     print("Ensure the file exists and the path is correct.")
@@ -17,14 +21,61 @@ except ImportError:
 
 # Setup Logger
 logger = frappe.logger("migration", allow_site=True, file_count=50)
+# Log records buffered in memory before being written to the log file (flushed every batch)
+LOG_BUFFER_CAPACITY = 1000
 
 # --- Configuration ---
 DEFAULT_BATCH_SIZE = 100
+# Batches processed between commits
+DEFAULT_COMMIT_EVERY = 1
+# Renames folded into a single CASE UPDATE ... WHERE field IN (...) statement
+LINK_UPDATE_CHUNK_SIZE = 500
+# Savepoint wrapping the writes of one batch
+RENAME_SAVEPOINT = "entropy_rename_batch"
+# Threads updating link tables in parallel; 0 keeps all updates on the main connection
+DEFAULT_LINK_WORKERS = 0
+
+# Flags set for the duration of the migration (see `run_migration`)
+MIGRATION_FLAGS = ("in_migrate", "in_install", "in_patch", "mute_emails")
 
 # --- Helper Functions ---
 
+@lru_cache(maxsize=4096)
+def _compiled_format_pattern(name_prefix, company_abbr):
+    """Returns the compiled pattern of an ID already in the new format: Prefix + CompanyAbbr + Padding digits (or more)."""
+    return re.compile(f"^{re.escape(name_prefix)}{re.escape(company_abbr)}\\d{{{DEFAULT_PADDING},}}$")
+
+
+def _expected_prefix_sql(name_field):
+    """
+    Returns a SQL expression for the PREFIX+COMPANY_ABBR an ID should start with.
+
+    Mirrors `get_name_prefix` (first `MAX_PREFIX_LENGTH` ASCII letters/digits, upper-cased,
+    `DEFAULT_NAME_PREFIX` if none) followed by the abbreviation of the joined Company `c`.
+    Evaluates to NULL if the company has no abbreviation; such records are left to the
+    format check in Python, which also resolves the user's default company.
+    """
+    name_prefix = (
+        f"COALESCE(NULLIF(UPPER(LEFT(REGEXP_REPLACE(t.`{name_field}`, '[^a-zA-Z0-9]', ''), {MAX_PREFIX_LENGTH})), ''), "
+        f"{frappe.db.escape(DEFAULT_NAME_PREFIX)})"
+    )
+    return f"CONCAT({name_prefix}, c.abbr)"
+
+
 def get_link_fields(doctype):
-    """Gets standard Link and Dynamic Link fields pointing to a given doctype."""
+    """
+    Gets standard Link and Dynamic Link fields pointing to a given doctype,
+    without self-references (its own `name`, Dynamic Links on the doctype itself).
+
+    The four meta queries run once per site and doctype in this process; migrating
+    Customer and Supplier in turn, or re-running after a failure, reuses the result.
+    """
+    return _get_link_fields_cached(frappe.local.site, doctype)
+
+
+@lru_cache(maxsize=None)
+def _get_link_fields_cached(site, doctype):
+    """Queries the Link and Dynamic Link field definitions; cached by `get_link_fields`."""
     link_fields = []
 
     # Standard Link Fields
@@ -50,164 +101,495 @@ def get_link_fields(doctype):
 
     dynamic_link_meta.extend(custom_dynamic_link_meta)
 
-    return link_fields, dynamic_link_meta
+    # Drop self-references once here, rather than checking them for every update
+    link_fields = [f for f in link_fields if not (f.parent == doctype and f.fieldname == "name")]
+    dynamic_link_meta = [m for m in dynamic_link_meta if m.parent != doctype]
 
+    # Tuples, so the cached result can't be modified by a caller
+    return tuple(link_fields), tuple(dynamic_link_meta)
 
-def update_links_for_document(doctype, old_name, new_name, link_fields, dynamic_link_meta, dry_run=False):
+
+def prune_link_fields(link_fields, dynamic_link_meta):
     """
-    Updates standard Link and Dynamic Link fields referencing the renamed document.
+    Drops link field definitions whose parent DocType has no rows to update.
+
+    Virtual DocTypes have no `tab{parent}` table, and many DocTypes with a link to
+    Customer/Supplier are never used on a given site. Checking each parent once per
+    migration keeps every later batch from issuing UPDATEs against them.
+    Fields without a column (e.g. a Custom Field whose column was never created) are
+    dropped with a warning, so the rename never has to tolerate a failing UPDATE.
+    Link fields of Single DocTypes store their values in `tabSingles`; they are kept
+    (marked with `issingle`) if a value is stored for them. Dynamic Links on Single
+    DocTypes are not handled and are dropped.
+
+    Args:
+        link_fields (list): Standard Link field definitions, from `get_link_fields`.
+        dynamic_link_meta (list): Dynamic Link field definitions, from `get_link_fields`.
+
+    Returns:
+        tuple: (link_fields, dynamic_link_meta) restricted to parents with data.
     """
-    logger.info(f"Updating links for {doctype}: {old_name} -> {new_name}")
+    single_doctypes = set(frappe.get_all("DocType", filters={"issingle": 1}, pluck="name"))
 
-    # 1. Update Standard Link Fields
-    for field in link_fields:
-        parent_doctype = field.parent
-        field_name = field.fieldname
-        # Skip self-references if any exist in DocField definitions
-        if parent_doctype == doctype and field_name == "name": 
+    columns = {} # { parent_doctype: set of column names }, only for parents with rows
+    for parent_doctype in {field.parent for field in link_fields} | {meta.parent for meta in dynamic_link_meta}:
+        if parent_doctype in single_doctypes:
             continue
+        if frappe.db.table_exists(parent_doctype) and frappe.db.sql(f"SELECT 1 FROM `tab{parent_doctype}` LIMIT 1"):
+            columns[parent_doctype] = set(frappe.db.get_table_columns(parent_doctype))
+
+    def has_columns(parent_doctype, *column_names):
+        missing = [column for column in column_names if column not in columns[parent_doctype]]
+        if missing:
+            logger.warning(f"Skipping link field {parent_doctype}.{column_names[0]}: "
+                           f"column(s) {', '.join(missing)} missing from `tab{parent_doctype}`.")
+        return not missing
+
+    pruned_link_fields = []
+    for field in link_fields:
+        if field.parent in columns:
+            if has_columns(field.parent, field.fieldname):
+                pruned_link_fields.append(field)
+        elif field.parent in single_doctypes and frappe.db.sql("""
+            SELECT 1 FROM `tabSingles`
+            WHERE `doctype` = %s AND `field` = %s AND COALESCE(`value`, '') != ''
+            LIMIT 1
+        """, (field.parent, field.fieldname)):
+            pruned_link_fields.append(frappe._dict(field, issingle=1))
+
+    return (
+        pruned_link_fields,
+        [meta for meta in dynamic_link_meta
+         if meta.parent in columns and has_columns(meta.parent, meta.fieldname, meta.options)],
+    )
+
+
+def get_name_references(doctype):
+    """
+    Lists the columns outside of Link fields that store the name of a `doctype` document.
+
+    Each entry is (table DocType, name column, column holding the doctype): child table
+    rows (`parent` / `parenttype`), attachments (`File.attached_to_name`) and document
+    history (`Version.docname`). These are what `frappe.rename_doc` updates besides links.
+
+    Args:
+        doctype (str): 'Customer' or 'Supplier'.
+
+    Returns:
+        list: Tuples of (table_doctype, name_column, doctype_column).
+    """
+    references = [
+        (table_field.options, "parent", "parenttype")
+        for table_field in frappe.get_meta(doctype).get_table_fields()
+    ]
+    references.append(("File", "attached_to_name", "attached_to_doctype"))
+    references.append(("Version", "docname", "ref_doctype"))
+    return references
+
+
+def rename_batch(doctype, rename_map, link_groups, single_link_fields, name_references,
+                 chunk_size=LINK_UPDATE_CHUNK_SIZE, link_workers=DEFAULT_LINK_WORKERS):
+    """
+    Renames all documents of a batch with bulk UPDATEs instead of `frappe.rename_doc`.
+
+    Links, the main table's `name`, child tables, attachments and versions are rewritten
+    with one `CASE` UPDATE per column per `chunk_size` renames. Everything
+    runs inside a savepoint, so a failing batch leaves no half-renamed documents behind.
+    Document hooks (`before_rename` / `after_rename`) are not run: this migration only
+    changes the ID format.
+
+    With `link_workers` > 1, link tables are updated in parallel on separate database
+    connections (see `_start_link_workers`). Their transactions can't join the savepoint,
+    so the batch is committed here, right after the worker transactions are.
+
+    Args:
+        doctype (str): 'Customer' or 'Supplier'.
+        rename_map (dict): { old_name: new_name } for the documents renamed in this batch.
+        link_groups (dict): Link fields per table, from `group_link_fields`.
+        single_link_fields (list): Link fields of Single DocTypes, from `group_link_fields`.
+        name_references (list): Other name columns, from `get_name_references`.
+        chunk_size (int): Renames per UPDATE statement.
+        link_workers (int): Threads updating link tables in parallel; 0 or 1 disables them.
+
+    Raises:
+        Exception: Any database error; the batch is rolled back to the savepoint first,
+                   or entirely if a link worker fails to finish its transaction.
+    """
+    finish_workers = None
+    if link_workers > 1:
+        # Tables the main connection writes to as well stay on it, so no two connections
+        # ever wait for each other's row locks
+        main_tables = {doctype} | {table_doctype for table_doctype, _, _ in name_references}
+        worker_groups = {parent: fields for parent, fields in link_groups.items() if parent not in main_tables}
+        link_groups = {parent: fields for parent, fields in link_groups.items() if parent in main_tables}
+        finish_workers = _start_link_workers(doctype, rename_map, worker_groups, chunk_size, link_workers)
+
+    renamed = False
+    try:
+        frappe.db.savepoint(RENAME_SAVEPOINT)
         try:
-            logger.debug(f"Checking links in {parent_doctype}.{field_name}")
-            update_query = f"""
-                UPDATE `tab{parent_doctype}`
-                SET `{field_name}` = %(new_name)s
-                WHERE `{field_name}` = %(old_name)s
-            """
-            if not dry_run:
-                frappe.db.sql(update_query, {"new_name": new_name, "old_name": old_name})
-            else:
-                # In dry run, we might check if any records *would* be updated
-                check_query = f"""
-                    SELECT COUNT(*) 
-                    FROM `tab{parent_doctype}` 
-                    WHERE `{field_name}` = %(old_name)s
-                """
-                count = frappe.db.sql(check_query, {"old_name": old_name})
-                if count and count[0][0] > 0:
-                    logger.info(f"[Dry Run] Would update {count[0][0]} links in {parent_doctype}.{field_name}")
+            # ** Crucial Step 1: Update Links **
+            update_links_for_batch(doctype, rename_map, link_groups, single_link_fields, chunk_size=chunk_size)
+
+            # ** Crucial Step 2: Rename Documents, their child rows and attachments **
+            for chunk in _chunk_pairs(rename_map, chunk_size):
+                _update_link_chunk(doctype, "name", chunk)
+                for table_doctype, name_column, doctype_column in name_references:
+                    _update_link_chunk(table_doctype, name_column, chunk, filters={doctype_column: doctype})
+        except Exception:
+            frappe.db.rollback(save_point=RENAME_SAVEPOINT)
+            raise
+        frappe.db.release_savepoint(RENAME_SAVEPOINT)
+        renamed = True
+    finally:
+        # Runs on every exit, KeyboardInterrupt included, so no worker is left waiting for a decision
+        if finish_workers:
+            try:
+                finish_workers(commit=renamed)
+            except Exception:
+                # A worker failed to commit or roll back: the main transaction must not
+                # commit without it, so the whole batch is discarded
+                frappe.db.rollback()
+                raise
+
+    if finish_workers:
+        frappe.db.commit()
 
-        except Exception as e:
-            # Log specific table/field errors but continue
-            logger.error(f"Error updating links in `tab{parent_doctype}`.{field_name} for {old_name}: {e}", exc_info=True)
+    # Cached copies of the documents under their old names are stale now
+    for old_name in rename_map:
+        frappe.clear_document_cache(doctype, old_name)
 
 
-    # 2. Update Dynamic Link Fields
+def _start_link_workers(doctype, rename_map, link_groups, chunk_size, workers):
+    """
+    Updates the link tables of a batch on `workers` threads, each with its own connection.
+
+    Tables are spread round-robin over the threads. Once every thread has issued its
+    UPDATEs, this returns; the threads then keep their transactions open until the
+    returned `finish(commit)` callback tells all of them to commit or roll back.
+
+    Args:
+        doctype (str): 'Customer' or 'Supplier'.
+        rename_map (dict): { old_name: new_name } for the documents renamed in this batch.
+        link_groups (dict): Link fields per table to update on the worker threads.
+        chunk_size (int): Renames per UPDATE statement.
+        workers (int): Maximum number of threads.
+
+    Returns:
+        callable: `finish(commit)`, waiting for all threads to commit (True) or roll back (False).
+                  None if there are no tables to update.
+
+    Raises:
+        Exception: If a thread failed to connect or any of its UPDATEs failed; all of them
+                   are rolled back first.
+    """
+    tables = list(link_groups.items())
+    if not tables:
+        return None
+
+    site, sites_path = frappe.local.site, frappe.local.sites_path
+    shares = [dict(tables[i::workers]) for i in range(min(workers, len(tables)))]
+    updated = threading.Barrier(len(shares) + 1) # Workers plus this thread
+    decided = threading.Event()
+    decision = {"commit": False}
+
+    def work(share):
+        try:
+            frappe.init(site=site, sites_path=sites_path)
+            frappe.connect()
+            # Raises on any failed UPDATE (see `update_links_for_batch`), so no worker
+            # commits a partial set of link tables
+            update_links_for_batch(doctype, rename_map, share, [], chunk_size=chunk_size)
+        except Exception:
+            updated.abort() # Wakes up everyone waiting, so the batch can be rolled back
+            frappe.db and frappe.db.rollback()
+            raise
+        finally:
+            if not updated.broken:
+                try:
+                    updated.wait()
+                    decided.wait()
+                    if decision["commit"]:
+                        frappe.db.commit()
+                    else:
+                        frappe.db.rollback()
+                except threading.BrokenBarrierError:
+                    frappe.db.rollback()
+            frappe.destroy()
+
+    executor = ThreadPoolExecutor(max_workers=len(shares), thread_name_prefix="entropy-link-update")
+    futures = [executor.submit(work, share) for share in shares]
+
+    def finish(commit):
+        decision["commit"] = commit
+        decided.set()
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown()
+
+    try:
+        updated.wait()
+    except threading.BrokenBarrierError:
+        finish(commit=False) # Raises the error of the failed thread
+        raise
+    return finish
+
+
+def group_link_fields(link_fields, dynamic_link_meta):
+    """
+    Groups the link fields to update by the table they live in.
+
+    A table like `tabSales Invoice` can reference a Customer from several fields (e.g.
+    a `customer` Link and a `party` Dynamic Link); grouping lets `update_links_for_batch`
+    rewrite all of them with a single UPDATE per table.
+
+    Args:
+        link_fields (list): Standard Link field definitions, from `prune_link_fields`.
+        dynamic_link_meta (list): Dynamic Link field definitions, from `prune_link_fields`.
+
+    Returns:
+        tuple: ({ parent_doctype: [(fieldname, options_fieldname), ...] }, [(single_doctype, fieldname), ...]).
+               `options_fieldname` is None for standard Links. Link fields of Single
+               DocTypes are listed separately, as they are stored in `tabSingles`.
+    """
+    link_groups = {}
+    single_link_fields = []
+
+    for field in link_fields:
+        if field.get("issingle"):
+            single_link_fields.append((field.parent, field.fieldname))
+        else:
+            _add_link_field(link_groups, field.parent, field.fieldname, None)
+
     for meta in dynamic_link_meta:
-        parent_doctype = meta.parent
-        dyn_link_fieldname = meta.fieldname # Field storing the name (e.g., 'link_name')
-        options_fieldname = meta.options # Field storing the doctype (e.g., 'link_doctype')
-
-        # Skip self-references
-        if parent_doctype == doctype:
-             continue
-             
+        # `fieldname` stores the name (e.g., 'link_name'), `options` the doctype (e.g., 'link_doctype')
+        _add_link_field(link_groups, meta.parent, meta.fieldname, meta.options)
+
+    return link_groups, single_link_fields
+
+
+def _add_link_field(link_groups, parent_doctype, field_name, options_fieldname):
+    """Adds a field to its table's group once; a column can only be SET once per UPDATE."""
+    fields = link_groups.setdefault(parent_doctype, [])
+    if all(existing != field_name for existing, _ in fields):
+        fields.append((field_name, options_fieldname))
+
+
+def update_links_for_batch(doctype, rename_map, link_groups, single_link_fields, dry_run=False,
+                           chunk_size=LINK_UPDATE_CHUNK_SIZE):
+    """
+    Updates standard Link and Dynamic Link fields referencing the renamed documents of a batch.
+
+    Instead of one UPDATE per link field per record, every table gets one UPDATE per
+    `chunk_size` renames, setting each of its link fields with
+    `CASE field WHEN old THEN new ... ELSE field END`.
+
+    A failing UPDATE is raised, so `rename_batch` rolls back the whole batch rather than
+    renaming documents whose links still point to the old names. Only a dry run logs
+    the error and moves on to the next table.
+
+    Args:
+        doctype (str): 'Customer' or 'Supplier'.
+        rename_map (dict): { old_name: new_name } for the documents renamed in this batch.
+        link_groups (dict): Link fields per table, from `group_link_fields`.
+        single_link_fields (list): Link fields of Single DocTypes, from `group_link_fields`.
+        dry_run (bool): Only count the links that would be updated.
+        chunk_size (int): Renames per UPDATE statement.
+
+    Raises:
+        Exception: Any database error, unless `dry_run` is set.
+    """
+    logger.debug("Updating links for %s %s records", len(rename_map), doctype)
+    chunks = _chunk_pairs(rename_map, chunk_size)
+
+    # 1. Update Link and Dynamic Link Fields, one statement per table
+    for parent_doctype, fields in link_groups.items():
         try:
-            logger.debug(f"Checking dynamic links in {parent_doctype} (link field: {dyn_link_fieldname}, type field: {options_fieldname})")
-            # Query where the type matches our doctype AND the name matches the old_name
-            update_query = f"""
-                UPDATE `tab{parent_doctype}`
-                SET `{dyn_link_fieldname}` = %(new_name)s
-                WHERE `{options_fieldname}` = %(target_doctype)s
-                  AND `{dyn_link_fieldname}` = %(old_name)s
-            """
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Checking links in %s (fields: %s)", parent_doctype, ", ".join(field for field, _ in fields))
+            for chunk in chunks:
+                _update_table_links_chunk(parent_doctype, fields, chunk, doctype, dry_run=dry_run)
+
+        except Exception as e:
             if not dry_run:
-                frappe.db.sql(update_query, {
-                    "new_name": new_name,
-                    "target_doctype": doctype,
-                    "old_name": old_name
-                })
-            else:
-                 check_query = f"""
-                    SELECT COUNT(*) 
-                    FROM `tab{parent_doctype}` 
-                    WHERE `{options_fieldname}` = %(target_doctype)s
-                      AND `{dyn_link_fieldname}` = %(old_name)s
-                 """
-                 count = frappe.db.sql(check_query, {"target_doctype": doctype, "old_name": old_name})
-                 if count and count[0][0] > 0:
-                    logger.info(f"[Dry Run] Would update {count[0][0]} dynamic links in {parent_doctype}.{dyn_link_fieldname}")
+                raise
+            # A dry run only counts; log the table's error and continue
+            logger.error(f"Error updating links in `tab{parent_doctype}`: {e}", exc_info=True)
+
+    # 2. Update Link Fields of Single DocTypes, kept as rows of `tabSingles`
+    for parent_doctype, field_name in single_link_fields:
+        try:
+            for chunk in chunks:
+                _update_link_chunk("Singles", "value", chunk,
+                                   filters={"doctype": parent_doctype, "field": field_name}, dry_run=dry_run)
 
         except Exception as e:
-            logger.error(f"Error updating dynamic links in `tab{parent_doctype}` for {old_name} (field: {dyn_link_fieldname}): {e}", exc_info=True)
+            if not dry_run:
+                raise
+            logger.error(f"Error updating links in {parent_doctype}.{field_name}: {e}", exc_info=True)
+
+
+def _chunk_pairs(rename_map, chunk_size):
+    """Splits a rename map into lists of at most `chunk_size` (old_name, new_name) pairs."""
+    pairs = list(rename_map.items())
+    return [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
 
 
-def generate_next_migration_id(doctype, name_field_value, company, existing_sequences):
+def _update_table_links_chunk(parent_doctype, fields, pairs, target_doctype, dry_run=False):
     """
-    Generates the next available ID for migration purposes.
-    Finds the highest existing sequence number for the name/company prefix
-    and increments it. Stores found max sequences in `existing_sequences` dict.
+    Rewrites every link field of `tab{parent_doctype}` for a chunk of (old_name, new_name) pairs
+    with a single UPDATE. Dynamic Link fields are only changed where their doctype field
+    equals `target_doctype`; every other value is kept by `ELSE field`.
+    """
+    old_names = [old_name for old_name, _ in pairs]
+    in_placeholders = ", ".join(["%s"] * len(old_names))
+    case_whens = " ".join(["WHEN %s THEN %s"] * len(pairs))
+    case_values = [value for pair in pairs for value in pair]
+
+    set_clauses, set_values = [], []
+    conditions, condition_values = [], []
+    for field_name, options_fieldname in fields:
+        if options_fieldname:
+            set_clauses.append(
+                f"`{field_name}` = CASE WHEN `{options_fieldname}` = %s "
+                f"THEN CASE `{field_name}` {case_whens} ELSE `{field_name}` END ELSE `{field_name}` END"
+            )
+            set_values += [target_doctype] + case_values
+            conditions.append(f"(`{options_fieldname}` = %s AND `{field_name}` IN ({in_placeholders}))")
+            condition_values += [target_doctype] + old_names
+        else:
+            set_clauses.append(f"`{field_name}` = CASE `{field_name}` {case_whens} ELSE `{field_name}` END")
+            set_values += case_values
+            conditions.append(f"`{field_name}` IN ({in_placeholders})")
+            condition_values += old_names
+
+    where = " OR ".join(conditions)
+    if dry_run:
+        # In dry run, only check how many records *would* be updated
+        count = frappe.db.sql(f"""
+            SELECT COUNT(*)
+            FROM `tab{parent_doctype}`
+            WHERE {where}
+        """, condition_values)
+        if count and count[0][0] > 0:
+            logger.info(f"[Dry Run] Would update links in {count[0][0]} {parent_doctype} records")
+        return
+
+    frappe.db.sql(f"""
+        UPDATE `tab{parent_doctype}`
+        SET {", ".join(set_clauses)}
+        WHERE {where}
+    """, set_values + condition_values)
+
+
+def _update_link_chunk(parent_doctype, field_name, pairs, filters=None, dry_run=False):
+    """
+    Rewrites `field_name` in `tab{parent_doctype}` for a chunk of (old_name, new_name) pairs
+    with a single `CASE` UPDATE. Only rows matching every `{column: value}` of `filters` are
+    touched (e.g. the doctype column of a Dynamic Link).
+    """
+    old_names = [old_name for old_name, _ in pairs]
+    in_placeholders = ", ".join(["%s"] * len(old_names))
+    condition = f"`{field_name}` IN ({in_placeholders})"
+    condition_values = list(old_names)
+    for column, value in (filters or {}).items():
+        condition += f" AND `{column}` = %s"
+        condition_values.append(value)
+
+    if dry_run:
+        # In dry run, only check how many records *would* be updated
+        count = frappe.db.sql(f"""
+            SELECT COUNT(*)
+            FROM `tab{parent_doctype}`
+            WHERE {condition}
+        """, condition_values)
+        if count and count[0][0] > 0:
+            logger.info(f"[Dry Run] Would update {count[0][0]} links in {parent_doctype}.{field_name}")
+        return
+
+    pair_values = [value for pair in pairs for value in pair]
+    case_whens = " ".join(["WHEN %s THEN %s"] * len(pairs))
+    frappe.db.sql(f"""
+        UPDATE `tab{parent_doctype}`
+        SET `{field_name}` = CASE `{field_name}` {case_whens} END
+        WHERE {condition}
+    """, pair_values + condition_values)
+
+
+def load_existing_sequences(doctype):
+    """
+    Finds the highest existing sequence number for every prefix in `tab{doctype}` at once.
+
+    Fetches every name ending in digits with a single query and aggregates in Python,
+    so `next_migration_id` never has to query the table for a prefix.
+    A name is counted under each way of splitting its trailing digits, as the prefix
+    itself may end in digits (e.g. company abbreviation "C2"): "SPAC2001" yields
+    {"SPAC": 2001, "SPAC2": 1, "SPAC20": 1, "SPAC200": 1}. This matches the
+    `^PREFIX(\\d+)$` pattern previously queried per prefix.
 
     Args:
         doctype (str): 'Customer' or 'Supplier'.
-        name_field_value (str): The value from customer_name or supplier_name.
-        company (str): The company associated with the record.
-        existing_sequences (dict): Cache to store max sequence found per prefix.
 
     Returns:
-        str: The newly generated ID in the format PREFIX+COMPANY_ABBR+SEQ.
-             Returns None if prefix/abbr cannot be generated.
+        dict: Max sequence number found per upper-cased prefix, e.g. { "SPAABC": 123 }.
     """
-    if not name_field_value:
-        logger.warning(f"Skipping ID generation: Name field is empty for a {doctype} record.")
-        return None
+    existing_sequences = {}
+    names = frappe.db.sql(f"""
+        SELECT name
+        FROM `tab{doctype}`
+        WHERE name REGEXP '[0-9]$'
+    """)
+
+    for (name,) in names:
+        # Names compare case-insensitively in the database, so prefixes are keyed in upper case
+        base = name.rstrip("0123456789").upper()
+        digits = name[len(base):]
+        # Every split point leaves at least one digit as the sequence number
+        for i in range(len(digits)):
+            prefix = base + digits[:i]
+            number = int(digits[i:])
+            if number > existing_sequences.get(prefix, 0):
+                existing_sequences[prefix] = number
+
+    logger.info(f"Loaded existing sequence numbers for {len(existing_sequences)} prefixes from {len(names)} {doctype} IDs.")
+    return existing_sequences
+
+
+def next_migration_id(combined_prefix, existing_sequences):
+    """
+    Gives out the next ID for an already computed PREFIX+COMPANY_ABBR, without any database access.
 
-    name_prefix = get_name_prefix(name_field_value)
-    company_abbr = get_company_abbr(company)
-    combined_prefix = f"{name_prefix}{company_abbr}"
+    Args:
+        combined_prefix (str): Name prefix followed by the company abbreviation (e.g., "SPAABC").
+        existing_sequences (dict): Max sequence per prefix, preloaded by `load_existing_sequences`.
 
-    # Check cache first
-    if combined_prefix in existing_sequences:
-        next_number = existing_sequences[combined_prefix] + 1
-    else:
-        # Query database for the highest existing ID with this prefix
-        # This needs to find IDs like "SPAABC001", "SPAABC123", etc.
-        query = f"""
-            SELECT name
-            FROM `tab{doctype}`
-            WHERE name LIKE %(like_pattern)s
-              AND name REGEXP %(regex_pattern)s -- Ensure it ends with numbers
-            ORDER BY name DESC
-            LIMIT 1
-        """
-        like_pattern = combined_prefix + "%"
-        # Regex to match the prefix followed ONLY by digits until the end
-        regex_pattern = f"^{re.escape(combined_prefix)}(\\d+)$" 
-        
-        try:
-            last_id_result = frappe.db.sql(query, {"like_pattern": like_pattern, "regex_pattern": regex_pattern})
-            
-            if last_id_result:
-                last_name = last_id_result[0][0]
-                match = re.search(regex_pattern, last_name)
-                if match:
-                    last_number = cint(match.group(1))
-                    next_number = last_number + 1
-                    logger.debug(f"Found existing max for {combined_prefix}: {last_name} (Num: {last_number}). Next is {next_number}.")
-                else:
-                    # Should not happen if regex in query worked, but handle defensively
-                    logger.warning(f"Regex mismatch for {last_name} with pattern {regex_pattern}. Starting sequence at 1 for {combined_prefix}.")
-                    next_number = 1
-            else:
-                # No existing IDs found with this prefix and numeric ending
-                logger.debug(f"No existing numeric IDs found for prefix {combined_prefix}. Starting sequence at 1.")
-                next_number = 1
-                
-        except Exception as e:
-            logger.error(f"Error querying max ID for {combined_prefix} in {doctype}: {e}", exc_info=True)
-            # Cannot safely generate ID if query fails
-            return None
+    Returns:
+        str: The newly generated ID (e.g., "SPAABC124").
+    """
+    # Every prefix present in the table was preloaded, so no database query is needed
+    sequence_key = combined_prefix.upper()
+    next_number = existing_sequences.get(sequence_key, 0) + 1
 
     # Update cache and generate new ID
-    existing_sequences[combined_prefix] = next_number
-    new_id = f"{combined_prefix}{cstr(next_number).zfill(DEFAULT_PADDING)}"
+    existing_sequences[sequence_key] = next_number
+    new_id = f"{combined_prefix}{next_number:0{DEFAULT_PADDING}d}"
     return new_id
 
 
 # --- Main Migration Logic ---
 
-def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH_SIZE, dry_run=False,
+                    commit_every=DEFAULT_COMMIT_EVERY, verbose_dry_run=False, link_chunk_size=LINK_UPDATE_CHUNK_SIZE,
+                    link_workers=DEFAULT_LINK_WORKERS):
     """
     Performs the ID migration for the specified doctype in batches.
+    Changes are committed after every `commit_every` batches and at the end.
+    Each UPDATE statement covers at most `link_chunk_size` renames.
+    With `link_workers` > 1, link tables are updated on that many threads and every
+    batch is committed on its own (see `rename_batch`).
+    A dry run only counts the links that would be updated if `verbose_dry_run` is set.
     """
     logger.info(f"{'DRY RUN: ' if dry_run else ''}Starting migration for DocType: {doctype}")
 
@@ -216,49 +598,83 @@ def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH
     renamed_count = 0
     skipped_count = 0
     failed_count = 0
-    start = 0
-    existing_sequences = {} # Cache for max sequence numbers found { "PREFIXABBR": max_num }
+    batch_count = 0
+    last_name = "" # Keyset pagination: the next batch starts after this name
+    new_names = set() # IDs given out by this run; renamed records can show up again in later batches
+    company_abbrs = {} # { company: abbr }; only a handful of companies repeat across all records
+    # Max sequence numbers per prefix { "PREFIXABBR": max_num }, loaded with one query
+    existing_sequences = load_existing_sequences(doctype)
 
     # Pre-fetch link field definitions once
     link_fields, dynamic_link_meta = get_link_fields(doctype)
-    logger.info(f"Found {len(link_fields)} standard link fields and {len(dynamic_link_meta)} dynamic link field definitions to check.")
+    logger.info(f"Found {len(link_fields)} standard link fields and {len(dynamic_link_meta)} dynamic link field definitions.")
+    # Skip parents without a table or without any rows for the whole run
+    link_fields, dynamic_link_meta = prune_link_fields(link_fields, dynamic_link_meta)
+    logger.info(f"{len(link_fields)} standard link fields and {len(dynamic_link_meta)} dynamic link fields are in tables with data and will be checked.")
+    # One UPDATE per table and chunk covers all of its link fields
+    link_groups, single_link_fields = group_link_fields(link_fields, dynamic_link_meta)
+    # Child tables, attachments and versions referring to the documents by name
+    name_references = get_name_references(doctype)
 
     # --- Batch Processing Loop ---
     while True:
-        logger.info(f"Processing batch starting from record: {start}")
+        logger.debug("Processing batch after record: '%s'", last_name)
         try:
-            # Fetch a batch of documents
-            records = frappe.get_list(
-                doctype,
-                fields=["name", name_field, company_field],
-                limit_start=start,
-                limit_page_length=batch_size,
-                order_by="name asc" # Process in a consistent order
-            )
+            # Fetch the next batch of documents by seeking past the last name seen,
+            # so the database doesn't re-read and discard all earlier rows (as OFFSET does)
+            # Plain SQL returning tuples: the script runs as Administrator, so the permission
+            # query and dict rows of frappe.get_list are pure overhead here.
+            # Records already in the new format are filtered out by the database (see
+            # `_expected_prefix_sql`), so a re-run doesn't pull them into Python at all.
+            # The batch is deliberately fetched in full rather than streamed (`as_iterator` /
+            # server-side cursor): renaming it runs further queries on the same connection,
+            # which an unread streaming result set would block. Rows are plain tuples and
+            # at most `batch_size` of them are held at once.
+            expected_prefix = _expected_prefix_sql(name_field)
+            # The prefix comparison must be case-sensitive, like the Python check;
+            # MariaDB compares case-insensitively unless told otherwise
+            records = frappe.db.sql(f"""
+                SELECT t.name, t.`{name_field}`, t.`{company_field}`
+                FROM `tab{doctype}` t
+                LEFT JOIN `tabCompany` c ON c.name = t.`{company_field}`
+                WHERE t.name > %s
+                AND NOT (
+                    COALESCE(c.abbr, '') != ''
+                    AND BINARY LEFT(t.name, CHAR_LENGTH({expected_prefix})) = BINARY {expected_prefix}
+                    AND SUBSTRING(t.name, CHAR_LENGTH({expected_prefix}) + 1) REGEXP '^[0-9]{{{DEFAULT_PADDING},}}$'
+                )
+                ORDER BY t.name ASC
+                LIMIT %s
+            """, (last_name, batch_size))
         except Exception as e:
-             logger.error(f"FATAL: Could not fetch batch for {doctype} starting at {start}. Aborting. Error: {e}", exc_info=True)
+             logger.error(f"FATAL: Could not fetch batch for {doctype} after '{last_name}'. Aborting. Error: {e}", exc_info=True)
              break # Exit the loop on fetch failure
 
         if not records:
             logger.info(f"No more records found for {doctype}.")
             break # Exit loop if no more records
 
-        # --- Process Records in Batch ---
-        for record in records:
+        batch_start_counts = (renamed_count, skipped_count, failed_count)
+
+        # --- Compute New IDs for the Batch ---
+        rename_map = {} # { old_name: new_name }, in processing order
+        for old_name, name_value, company_value in records:
+            # A record renamed earlier in this run, reached again under its new name
+            if old_name in new_names:
+                continue
             processed_count += 1
-            old_name = record.name
-            name_value = record.get(name_field)
-            company_value = record.get(company_field)
 
             # --- Check if already in correct format ---
             try:
-                current_name_prefix = get_name_prefix(name_value)
-                current_company_abbr = get_company_abbr(company_value)
-                # Pattern: Prefix + CompanyAbbr + Padding digits (or more)
-                correct_format_pattern = f"^{re.escape(current_name_prefix)}{re.escape(current_company_abbr)}\\d{{{DEFAULT_PADDING},}}$"
-
-                if re.match(correct_format_pattern, old_name):
-                    logger.debug(f"Skipping {old_name} - already in correct format.")
+                current_name_prefix = get_name_prefix(name_value) # lru_cached in custom_naming
+                current_company_abbr = company_abbrs.get(company_value)
+                if current_company_abbr is None:
+                    current_company_abbr = company_abbrs[company_value] = get_company_abbr(company_value)
+                # Pattern: Prefix + CompanyAbbr + Padding digits (or more), compiled once per prefix
+                correct_format_pattern = _compiled_format_pattern(current_name_prefix, current_company_abbr)
+
+                if correct_format_pattern.match(old_name):
+                    logger.debug("Skipping %s - already in correct format.", old_name)
                     skipped_count += 1
                     continue # Move to the next record in the batch
             except Exception as e:
@@ -268,13 +684,15 @@ def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH
 
 
             # --- Generate New ID ---
+            if not name_value:
+                logger.error(f"Failed to generate new ID for {old_name} (Name: {name_value}, Company: {company_value}): name field is empty. Skipping.")
+                failed_count += 1
+                continue
+
             try:
-                 new_name = generate_next_migration_id(doctype, name_value, company_value, existing_sequences)
-                 if not new_name:
-                     logger.error(f"Failed to generate new ID for {old_name} (Name: {name_value}, Company: {company_value}). Skipping.")
-                     failed_count += 1
-                     continue
-                 
+                 # Reuses the prefix and abbreviation from the format check; only a dict increment is left
+                 new_name = next_migration_id(f"{current_name_prefix}{current_company_abbr}", existing_sequences)
+
                  # Prevent accidental renaming to the same name (should be caught by format check, but belt-and-suspenders)
                  if new_name == old_name:
                      logger.warning(f"Generated new name {new_name} is identical to old name {old_name}. Skipping.")
@@ -286,49 +704,52 @@ def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH
                 failed_count += 1
                 continue # Skip this record
 
+            rename_map[old_name] = new_name
+            new_names.add(new_name)
 
-            # --- Perform Rename (within try...except for this record) ---
+        # --- Rename the Whole Batch ---
+        if rename_map and not dry_run:
             try:
-                logger.info(f"Attempting rename: {old_name} -> {new_name}")
-
-                # ** Crucial Step 1: Update Links **
-                update_links_for_document(doctype, old_name, new_name, link_fields, dynamic_link_meta, dry_run)
-
-                # ** Crucial Step 2: Rename Document **
-                if not dry_run:
-                    # Use force=True cautiously, ensures rename happens even if hooks fail, but link updates are vital
-                    # Setting ignore_permissions=True is often needed for migrations run by Admin
-                    frappe.rename_doc(doctype, old_name, new_name, force=True, ignore_permissions=True) 
-                    logger.info(f"Successfully renamed: {old_name} -> {new_name}")
-                else:
-                    logger.info(f"[Dry Run] Would rename {doctype}: {old_name} -> {new_name}")
-
-                renamed_count += 1
+                logger.debug("Renaming %s %s records", len(rename_map), doctype)
+                rename_batch(doctype, rename_map, link_groups, single_link_fields, name_references,
+                             chunk_size=link_chunk_size, link_workers=link_workers)
+                for old_name, new_name in rename_map.items():
+                    logger.debug("Successfully renamed: %s -> %s", old_name, new_name)
+                renamed_count += len(rename_map)
 
             except Exception as e:
-                logger.error(f"FAILED to rename {doctype}: {old_name} -> {new_name}. Error: {e}", exc_info=True)
-                failed_count += 1
-                # IMPORTANT: If rename_doc fails after links were updated (in non-dry-run),
-                # manual intervention might be needed for this record.
-                # The database transaction *should* handle this if run via `bench execute`,
-                # but logging the failure clearly is vital.
-                if not dry_run:
-                     logger.critical(f"Potential data inconsistency for {old_name}. Links might point to {new_name}, but rename failed.")
-                     # We do NOT rollback the whole batch here, just log the individual failure.
-                     # Periodic commits ensure prior successes are saved.
-
-            # --- Periodic Commit (outside individual record try/except) ---
-            if processed_count % batch_size == 0:
-                 if not dry_run:
-                    logger.info(f"Committing changes after {processed_count} records...")
-                    frappe.db.commit()
-                    logger.info("Commit successful.")
-                 else:
-                    logger.info(f"[Dry Run] Would commit after {processed_count} records.")
+                # The batch was rolled back to its savepoint: neither links nor names were changed
+                logger.error(f"FAILED to rename batch of {len(rename_map)} {doctype} records "
+                             f"({', '.join(rename_map)}). Rolled back. Error: {e}", exc_info=True)
+                failed_count += len(rename_map)
+
+        elif rename_map:
+            # Counting links costs a query per table and chunk; only done when asked for
+            if verbose_dry_run:
+                update_links_for_batch(doctype, rename_map, link_groups, single_link_fields, dry_run=True,
+                                       chunk_size=link_chunk_size)
+            for old_name, new_name in rename_map.items():
+                logger.info(f"[Dry Run] Would rename {doctype}: {old_name} -> {new_name}")
+            renamed_count += len(rename_map)
+
+        # --- Periodic Commit (after every `commit_every` batches) ---
+        batch_count += 1
+        if batch_count % commit_every == 0:
+             if not dry_run:
+                logger.debug("Committing changes after %s records...", processed_count)
+                frappe.db.commit()
+                logger.debug("Commit successful.")
+             else:
+                logger.debug("[Dry Run] Would commit after %s records.", processed_count)
+
+        # --- Batch Summary ---
+        logger.info(f"Batch {batch_count}: renamed={renamed_count - batch_start_counts[0]}, "
+                    f"skipped={skipped_count - batch_start_counts[1]}, failed={failed_count - batch_start_counts[2]}")
+        _flush_log_handlers()
 
 
         # --- End of Batch ---
-        start += batch_size # Move to the next batch
+        last_name = records[-1][0] # Move to the next batch
 
     # --- Final Commit ---
     if not dry_run:
@@ -349,8 +770,51 @@ def migrate_doctype(doctype, name_field, company_field, batch_size=DEFAULT_BATCH
 
     return failed_count == 0 # Return True if successful, False otherwise
 
+# --- Logging Helpers ---
+
+def _buffer_log_handlers():
+    """
+    Wraps the migration logger's handlers in `MemoryHandler`s, so per-record log lines
+    are written in bulk instead of one file write each. Errors are written immediately.
+
+    Returns:
+        list: The original handlers, for `_restore_log_handlers`.
+    """
+    original_handlers = list(logger.handlers)
+    for handler in original_handlers:
+        logger.removeHandler(handler)
+        logger.addHandler(MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=handler))
+    return original_handlers
+
+
+def _flush_log_handlers():
+    """Writes out buffered log records; called once per batch."""
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def _restore_log_handlers(original_handlers):
+    """Flushes and removes the buffering handlers and puts the original handlers back."""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if isinstance(handler, MemoryHandler):
+            handler.flush()
+            handler.setTarget(None) # Detach, so closing it can't touch the original handler
+            handler.close()
+    for handler in original_handlers:
+        logger.addHandler(handler)
+
+
 # --- Script Execution ---
 
+def _positive_int(value):
+    """argparse type: an integer of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def run_migration(args):
     """Sets up flags and runs the migration for the specified doctype."""
 
@@ -367,17 +831,21 @@ def run_migration(args):
             print("Migration aborted by user.")
             return
 
-    # Set flags often needed for migrations
+    # Set flags often needed for migrations; previous values are restored afterwards
+    previous_flags = {flag: frappe.flags.get(flag) for flag in MIGRATION_FLAGS}
     frappe.flags.in_migrate = True
     frappe.flags.in_install = True # Helps bypass certain hooks/validations
+    frappe.flags.in_patch = True # Skips patch-sensitive side effects, like during `bench migrate`
+    frappe.flags.mute_emails = True # No notifications for the bulk-changed documents
     #frappe.db.auto_commit_on_many_writes = True # Use explicit commits instead
 
     success = False
+    original_log_handlers = _buffer_log_handlers()
     try:
         if args.doctype == "Customer":
-            success = migrate_doctype("Customer", "customer_name", "company", args.batch_size, args.dry_run)
+            success = migrate_doctype("Customer", "customer_name", "company", args.batch_size, args.dry_run, args.commit_every, args.verbose_dry_run, args.link_chunk_size, args.link_workers)
         elif args.doctype == "Supplier":
-            success = migrate_doctype("Supplier", "supplier_name", "company", args.batch_size, args.dry_run)
+            success = migrate_doctype("Supplier", "supplier_name", "company", args.batch_size, args.dry_run, args.commit_every, args.verbose_dry_run, args.link_chunk_size, args.link_workers)
         else:
             logger.error(f"Unsupported doctype specified: {args.doctype}")
             print(f"ERROR: Unsupported doctype: {args.doctype}. Choose 'Customer' or 'Supplier'.")
@@ -388,9 +856,9 @@ def run_migration(args):
         frappe.db.rollback() # Rollback any uncommitted changes
         print("Rolled back current transaction.")
     finally:
-        # Unset flags
-        frappe.flags.in_migrate = False
-        frappe.flags.in_install = False
+        # Restore flags
+        frappe.flags.update(previous_flags)
+        _restore_log_handlers(original_log_handlers)
         #frappe.db.auto_commit_on_many_writes = False
 
         if success:
@@ -405,7 +873,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Migrate Customer/Supplier IDs to new format (PREFIX+COMPANY+SEQ).")
     parser.add_argument("doctype", choices=["Customer", "Supplier"], help="Specify the DocType to migrate (Customer or Supplier).")
     parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Number of records to process per batch (default: {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--commit-every", type=_positive_int, default=DEFAULT_COMMIT_EVERY, help=f"Number of batches to process between commits (default: {DEFAULT_COMMIT_EVERY}).")
+    parser.add_argument("--link-chunk-size", type=_positive_int, default=LINK_UPDATE_CHUNK_SIZE, help=f"Maximum number of renames per UPDATE statement (default: {LINK_UPDATE_CHUNK_SIZE}).")
+    parser.add_argument("--link-workers", type=int, default=DEFAULT_LINK_WORKERS, help="Number of threads (and database connections) updating link tables in parallel (default: off).")
     parser.add_argument("--dry-run", action="store_true", help="Simulate the migration without making any database changes.")
+    parser.add_argument("--verbose-dry-run", action="store_true", help="With --dry-run, also count the links that would be updated (slower).")
     parser.add_argument("--yes", "-y", action="store_true", help="Skip the confirmation prompt (USE WITH CAUTION!).")
 
     args = parser.parse_args()